@@ -0,0 +1,68 @@
+import numpy as np
+from scipy import constants
+from scipy import special
+from GaussianBunchField import Gaussian_Bunch, transverse_field_2d
+'''
+Weak-strong beam-beam kicks for particle tracking.
+The strong bunch is a Gaussian_Bunch cut into longitudinal slices of equal charge. Every slice acts with the transverse
+field of a 2D Gaussian line charge, i.e. the gam*sigma_z >> sigma_x, sigma_y limit of the Gaussian_Bunch integrals,
+so the kick is closed form (Bassetti-Erskine or the round-beam formula) and vectorized over the particles.
+The test particles move in +z, head-on against the bunch (the direction implied by the B field of Gaussian_Bunch).
+Coordinates are x [m], px = p_x/p0, y [m], py = p_y/p0, z [m] (positive towards the head), delta = dp/p0.
+'''
+
+
+class Beam_Beam_Kick:
+
+    def __init__(self, bunch, Energy, n_slices=10, charge=1):
+        '''
+        bunch: strong Gaussian_Bunch, Energy: energy of the test particles (same units as Gaussian_Bunch),
+        n_slices: number of equal-charge slices, charge: charge of a test particle in units of e
+        (the fields of Gaussian_Bunch are those of Number_e positive charges, use a negative charge for
+        oppositely charged beams).
+        '''
+        self.bunch = bunch
+        self.Energy = Energy
+        self.n_slices = n_slices
+        self.charge = charge
+        self.gam = Energy / Gaussian_Bunch.mass_e
+        self.beta = (1 - 1 / (self.gam ** 2)) ** (0.5)
+
+        # slice centroids: mean z of the bunch between neighbouring quantiles of the Gaussian profile
+        edges = special.ndtri(np.linspace(0, 1, n_slices + 1))
+        pdf = np.exp(-edges ** 2 / 2) / (2 * np.pi) ** 0.5
+        self.z_slices = bunch.sigma_z * (pdf[:-1] - pdf[1:]) * n_slices
+
+    def __Get_kick_strength(self):
+        # p0 * delta(p_perp) = q * (E + v x B) integrated over the passage of a slice, per unit of transverse
+        # field f = E * epsilon_0 / lambda of the slice. With B_x = beta_s/c*E_y, B_y = -beta_s/c*E_x of
+        # Gaussian_Bunch and v = beta_p*c along z, E + v x B = (1 + beta_p*beta_s) * E. The line charge passes at
+        # the relative velocity (beta_p + beta_s)*c, so int lambda dt = Q_slice / ((beta_p + beta_s)*c).
+        bunch = self.bunch
+        q_slice = constants.e * bunch.Number_e / self.n_slices
+        p0 = self.Energy * constants.e * self.beta / constants.c
+        return self.charge * constants.e * (1 + self.beta * bunch.beta) * q_slice / \
+            (Gaussian_Bunch.epsilon_0 * (self.beta + bunch.beta) * constants.c) / p0
+
+    def track(self, x, px, y, py, z, delta):
+        '''
+        Applies the kicks of all slices to the particle arrays in place. Each slice kicks at its collision point
+        S = (z - z_slice)/2: drift to S, kick, drift back. delta changes by the energy term of the z-dependent
+        drifts, which keeps the map symplectic.
+        '''
+        for array in (x, px, y, py, z, delta):
+            if not isinstance(array, np.ndarray) or array.dtype != np.float64:
+                raise TypeError('particle coordinates must be float64 numpy arrays, they are updated in place')
+        strength = self.__Get_kick_strength()
+        for z_slice in self.z_slices:
+            S = (z - z_slice) / 2
+            x += px * S
+            y += py * S
+            f_x, f_y = transverse_field_2d(x, y, self.bunch.sigma_x, self.bunch.sigma_y)
+            kick_x = strength * f_x
+            kick_y = strength * f_y
+            delta += (kick_x * (px + kick_x / 2) + kick_y * (py + kick_y / 2)) / 2
+            px += kick_x
+            py += kick_y
+            x -= px * S
+            y -= py * S
@@ -0,0 +1,202 @@
+import argparse
+import functools
+import json
+import platform
+import time
+import warnings
+import numpy as np
+import scipy
+from scipy import constants
+from scipy import integrate
+from GaussianBunchField import Gaussian_Bunch
+'''
+Speed and accuracy benchmark of the Gaussian_Bunch field evaluation.
+Every method is run over a matrix of regimes (round / flat beams, low / high gamma, points in the core and in the far
+tail beyond 50 sigma) and reports points per second, quad calls per point and the largest relative error against a
+high precision mpmath reference (skipped if mpmath is not installed). The results are written to a JSON file so that
+runs of different versions can be compared.
+    python Benchmark.py --output bench.json
+'''
+
+try:
+    import mpmath
+except ImportError:
+    mpmath = None
+
+BUNCHES = {
+    'round_low_gamma': dict(Energy=5e6, sigma_x=1e-4, sigma_y=1e-4, sigma_z=1e-4, Number_e=1e10),
+    'round_high_gamma': dict(Energy=50e9, sigma_x=1e-5, sigma_y=1e-5, sigma_z=1e-3, Number_e=1e10),
+    'flat_low_gamma': dict(Energy=5e6, sigma_x=1e-4, sigma_y=1e-6, sigma_z=1e-4, Number_e=1e10),
+    'flat_high_gamma': dict(Energy=50e9, sigma_x=1e-5, sigma_y=1e-7, sigma_z=1e-3, Number_e=1e10),
+    'example': dict(Energy=0.4e9, sigma_x=1e-4, sigma_y=1e-4, sigma_z=1e-7, Number_e=2e4),
+}
+
+
+def make_points(bunch, region, n, rng):
+    # points in units of sigma: 'core' inside 3 sigma, 'far_tail' with |x| or |y| between 50 and 200 sigma
+    u = rng.uniform(-3, 3, (3, n))
+    if region == 'far_tail':
+        axis = rng.integers(0, 2, n)
+        u[axis, np.arange(n)] = rng.choice([-1, 1], n) * rng.uniform(50, 200, n)
+    return u[0] * bunch.sigma_x, u[1] * bunch.sigma_y, u[2] * bunch.sigma_z
+
+
+@functools.lru_cache(maxsize=None)
+def reference_E(bunch, x, y, z, component, axis=None):
+    # E component (axis=None) or dE_component/d(axis) from the q integral evaluated with mpmath
+    mpmath.mp.dps = 30
+    r = [mpmath.mpf(x), mpmath.mpf(y), mpmath.mpf(z) * bunch.gam]
+    b = [2 * mpmath.mpf(bunch.sigma_x) ** 2, 2 * mpmath.mpf(bunch.sigma_y) ** 2,
+         2 * (mpmath.mpf(bunch.sigma_z) * bunch.gam) ** 2]
+
+    def fun(q):
+        a = [q + b_i for b_i in b]
+        kernel = mpmath.exp(-sum(r_i ** 2 / a_i for r_i, a_i in zip(r, a))) / mpmath.sqrt(a[0] * a[1] * a[2])
+        if axis is None:
+            return 2 * r[component] / a[component] * kernel
+        return 2 / a[component] * ((component == axis) - 2 * r[component] * r[axis] / a[axis]) * kernel
+
+    breaks = sorted(set([mpmath.mpf(0)] + b + [r_i ** 2 for r_i in r if r_i != 0]))
+    value = mpmath.quad(fun, breaks + [mpmath.inf])
+    factor = constants.e * bunch.Number_e / np.pi ** 0.5 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
+    scale = (bunch.gam if component < 2 else 1) * (bunch.gam if axis == 2 else 1)
+    return float(value) * factor * scale
+
+
+def _scalar(getter, prop):
+    def run(bunch, x, y, z):
+        getattr(bunch, getter)(x, y, z)
+        return getattr(bunch, prop)
+    return run
+
+
+def _fields_at_E(bunch, x, y, z):
+    fields = bunch.fields_at(x, y, z)
+    return [fields['E_x'], fields['E_y'], fields['E_z']]
+
+
+# name: (function(bunch, x, y, z) -> value at one point, reference(bunch, x, y, z) -> value)
+SCALAR_METHODS = {
+    'Get_E_x': (_scalar('Get_E_x', 'E_x'), lambda b, x, y, z: reference_E(b, x, y, z, 0)),
+    'Get_E_y': (_scalar('Get_E_y', 'E_y'), lambda b, x, y, z: reference_E(b, x, y, z, 1)),
+    'Get_E_z': (_scalar('Get_E_z', 'E_z'), lambda b, x, y, z: reference_E(b, x, y, z, 2)),
+    'Get_E_x_derivative_x': (_scalar('Get_E_x_derivative_x', 'E_x_derivative_x'),
+                             lambda b, x, y, z: reference_E(b, x, y, z, 0, 0)),
+    'Get_E_y_derivative_y': (_scalar('Get_E_y_derivative_y', 'E_y_derivative_y'),
+                             lambda b, x, y, z: reference_E(b, x, y, z, 1, 1)),
+    'Get_E_z_derivative_z': (_scalar('Get_E_z_derivative_z', 'E_z_derivative_z'),
+                             lambda b, x, y, z: reference_E(b, x, y, z, 2, 2)),
+    'Get_B_x': (_scalar('Get_B_x', 'B_x'), lambda b, x, y, z: b.beta / constants.c * reference_E(b, x, y, z, 1)),
+    'Get_B_y': (_scalar('Get_B_y', 'B_y'), lambda b, x, y, z: -b.beta / constants.c * reference_E(b, x, y, z, 0)),
+    'fields_at': (lambda b, x, y, z: _fields_at_E(b, x, y, z),
+                  lambda b, x, y, z: [reference_E(b, x, y, z, i) for i in range(3)]),
+}
+
+# name: function(bunch, x, y, z) -> array (3, n) of E_x, E_y, E_z for arrays of points
+BATCH_METHODS = {
+    'evaluate_fields_auto': lambda b, x, y, z: np.array(b.evaluate_fields(x, y, z)[:3]),
+    'evaluate_fields_quadrature': lambda b, x, y, z: np.array(b.evaluate_fields(x, y, z, engine='quadrature')[:3]),
+    'evaluate_fields_vector': lambda b, x, y, z: np.array(b.evaluate_fields(x, y, z, engine='vector')[:3]),
+    'evaluate_fields_vector_tol': lambda b, x, y, z: np.array(b.evaluate_fields(x, y, z, engine='vector',
+                                                                                tol=1e-8)[:3]),
+    'evaluate_fields_vector_float32': lambda b, x, y, z: np.array(b.evaluate_fields(x, y, z, engine='vector',
+                                                                                    dtype=np.float32)[:3]),
+}
+
+
+class _Quad_Counter:
+    # counts calls of integrate.quad and integrate.quad_vec while active
+    def __enter__(self):
+        self.calls = 0
+        self.__originals = integrate.quad, integrate.quad_vec
+
+        def counted(fun):
+            def wrapper(*args, **kwargs):
+                self.calls += 1
+                return fun(*args, **kwargs)
+            return wrapper
+
+        integrate.quad, integrate.quad_vec = (counted(f) for f in self.__originals)
+        return self
+
+    def __exit__(self, *exc):
+        integrate.quad, integrate.quad_vec = self.__originals
+
+
+def _relative_error(values, references):
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    references = np.atleast_1d(np.asarray(references, dtype=float))
+    scale = np.maximum(np.abs(references), 1e-300)
+    return float(np.max(np.abs(values - references) / scale))
+
+
+def run_benchmarks(n_points=10, n_batch=20000, seed=0, accuracy=True, regimes=None, methods=None):
+    accuracy = accuracy and mpmath is not None
+    rng = np.random.default_rng(seed)
+    results = []
+    for bunch_name, parameters in BUNCHES.items():
+        bunch = Gaussian_Bunch(**parameters)
+        for region in ('core', 'far_tail'):
+            regime = bunch_name + '/' + region
+            if regimes is not None and regime not in regimes:
+                continue
+            x, y, z = make_points(bunch, region, n_points, rng)
+            for name, (fun, reference) in SCALAR_METHODS.items():
+                if methods is not None and name not in methods:
+                    continue
+                fun(bunch, x[0], y[0], z[0])  # compile / warm up
+                with warnings.catch_warnings(), _Quad_Counter() as counter:
+                    warnings.simplefilter('ignore')
+                    start = time.perf_counter()
+                    values = [fun(bunch, *p) for p in zip(x, y, z)]
+                    elapsed = time.perf_counter() - start
+                results.append({'regime': regime, 'method': name, 'points': n_points,
+                                'points_per_second': n_points / elapsed,
+                                'quad_calls_per_point': counter.calls / n_points,
+                                'max_rel_error': _relative_error(values, [reference(bunch, *p) for p in zip(x, y, z)])
+                                if accuracy else None})
+
+            bx, by, bz = make_points(bunch, region, n_batch, rng)
+            for name, fun in BATCH_METHODS.items():
+                if methods is not None and name not in methods:
+                    continue
+                with _Quad_Counter() as counter:
+                    start = time.perf_counter()
+                    fun(bunch, bx, by, bz)
+                    elapsed = time.perf_counter() - start
+                error = None
+                if accuracy:
+                    values = fun(bunch, x, y, z)
+                    reference = [[reference_E(bunch, *p, i) for p in zip(x, y, z)] for i in range(3)]
+                    error = _relative_error(values, reference)
+                results.append({'regime': regime, 'method': name, 'points': n_batch,
+                                'points_per_second': n_batch / elapsed,
+                                'quad_calls_per_point': counter.calls / n_batch,
+                                'max_rel_error': error})
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'mpmath': mpmath.__version__ if mpmath is not None else None,
+            'n_points': n_points, 'n_batch': n_batch, 'seed': seed, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed and accuracy benchmark of Gaussian_Bunch')
+    parser.add_argument('--output', default='bench.json', help='JSON file for the results')
+    parser.add_argument('--points', type=int, default=10, help='points per regime for the scalar methods')
+    parser.add_argument('--batch', type=int, default=20000, help='points per regime for the batch methods')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-accuracy', action='store_true', help='skip the mpmath reference values')
+    parser.add_argument('--regime', action='append', help='only run these regimes, e.g. flat_high_gamma/core')
+    parser.add_argument('--method', action='append', help='only run these methods, e.g. Get_E_x')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.points, args.batch, args.seed, not args.no_accuracy, args.regime, args.method)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    for r in report['results']:
+        error = '' if r['max_rel_error'] is None else '{:9.1e}'.format(r['max_rel_error'])
+        print('{:28s} {:28s} {:12.0f} pts/s {:8.2f} quad/pt {}'.format(
+            r['regime'], r['method'], r['points_per_second'], r['quad_calls_per_point'], error))
+
+
+if __name__ == '__main__':
+    main()
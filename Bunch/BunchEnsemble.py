@@ -0,0 +1,78 @@
+import numpy as np
+from scipy import constants
+from GaussianBunchField import Gaussian_Bunch
+'''
+Field of a superposition of Gaussian bunches, e.g. a bunch train or a Gaussian mixture fitted to a measured profile.
+Every component is a Gaussian_Bunch with its own offset and charge. Components with the same energy and sigmas form a
+group that is evaluated by one vectorized call on all (point - offset) pairs, so the quadrature nodes and the
+closed-form dispatch of Gaussian_Bunch.evaluate_fields are shared by the whole group, and the cost grows with the number
+of distinct (shape, offset) pairs rather than the number of components added.
+'''
+
+
+class Bunch_Ensemble:
+
+    def __init__(self):
+        self.__groups = {}
+
+    def add_bunch(self, bunch, x0=0, y0=0, z0=0):
+        # bunch centred at (x0, y0, z0), z0 measured in the laboratory frame like z
+        # components with the same shape and offset only differ in charge and are merged into one
+        key = (bunch.Energy, bunch.sigma_x, bunch.sigma_y, bunch.sigma_z)
+        group = self.__groups.setdefault(key, {'offsets': [], 'Number_e': []})
+        offset = (float(x0), float(y0), float(z0))
+        if offset in group['offsets']:
+            group['Number_e'][group['offsets'].index(offset)] += bunch.Number_e
+        else:
+            group['offsets'].append(offset)
+            group['Number_e'].append(bunch.Number_e)
+
+    @classmethod
+    def from_longitudinal_mixture(cls, Energy, sigma_x, sigma_y, Number_e, weights, z_centers, sigmas_z):
+        # bunch with a longitudinal profile given as a Gaussian mixture, weights are normalized to Number_e
+        weights = np.asarray(weights, dtype=float)
+        ensemble = cls()
+        for weight, z0, sigma_z in zip(weights / weights.sum(), z_centers, sigmas_z):
+            ensemble.add_bunch(Gaussian_Bunch(Energy, sigma_x, sigma_y, sigma_z, weight * Number_e), z0=z0)
+        return ensemble
+
+    @property
+    def Number_e(self):
+        return sum(sum(group['Number_e']) for group in self.__groups.values())
+
+    @property
+    def n_groups(self):
+        return len(self.__groups)
+
+    @property
+    def n_components(self):
+        return sum(len(group['offsets']) for group in self.__groups.values())
+
+    def evaluate_fields(self, x, y, z, max_pairs=1 << 20, **options):
+        '''
+        Same call and return values as Gaussian_Bunch.evaluate_fields (E_x, E_y, E_z, B_x, B_y), summed over all
+        components. The points are taken in chunks of at most max_pairs (point, component) pairs per group, which
+        bounds the temporary memory. options are passed on to Gaussian_Bunch.evaluate_fields.
+        '''
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                      np.asarray(z, dtype=float))
+        shape = x.shape
+        x, y, z = x.ravel(), y.ravel(), z.ravel()
+        E = np.zeros((3, x.size))
+        B_x = np.zeros(x.size)
+        B_y = np.zeros(x.size)
+        for (Energy, sigma_x, sigma_y, sigma_z), group in self.__groups.items():
+            unit_bunch = Gaussian_Bunch(Energy, sigma_x, sigma_y, sigma_z, 1)
+            offsets = np.array(group['offsets'])
+            charges = np.array(group['Number_e'], dtype=float)
+            rows = max(1, max_pairs // len(offsets))
+            for start in range(0, x.size, rows):
+                sl = slice(start, start + rows)
+                # one row per component, all rows go through the same quadrature in a single call
+                fields = unit_bunch.evaluate_fields(x[sl] - offsets[:, 0:1], y[sl] - offsets[:, 1:2],
+                                                    z[sl] - offsets[:, 2:3], **options)
+                group_E = np.array([charges @ fields[i] for i in range(3)])
+                E[:, sl] += group_E
+                B_x[sl] += unit_bunch.beta / constants.c * group_E[1]
+                B_y[sl] -= unit_bunch.beta / constants.c * group_E[0]
+        return E[0].reshape(shape), E[1].reshape(shape), E[2].reshape(shape), B_x.reshape(shape), B_y.reshape(shape)
@@ -0,0 +1,37 @@
+import matplotlib.pyplot as plt
+import numpy as np
+'''
+Plots of Gaussian_Bunch fields, kept apart from GaussianBunchField.py so that the field code does not need matplotlib.
+'''
+
+_AXES = {'x': 0, 'y': 1, 'z': 2}
+
+
+def plot_field_line(bunch, component, axis, start, stop, num=300, x=0, y=0, z=0, derivative=False, ax=None):
+    '''
+    Field component ('E_x', 'E_y', 'E_z', 'B_x' or 'B_y') along the line x, y or z = start ... stop (in units of
+    sigma of that axis) through (x, y, z). With derivative=True the derivative of the E component along the line is
+    drawn in red on a twin axis. Returns the matplotlib axes.
+    '''
+    names = ('E_x', 'E_y', 'E_z', 'B_x', 'B_y')
+    k = _AXES[axis]
+    sigma = (bunch.sigma_x, bunch.sigma_y, bunch.sigma_z)[k]
+    line = np.linspace(start * sigma, stop * sigma, num)
+    points = [np.full(num, float(v)) for v in (x, y, z)]
+    points[k] = line
+    fields = bunch.evaluate_fields(*points)
+
+    if ax is None:
+        fig, ax = plt.subplots(1)
+    ax.plot(line / sigma, fields[names.index(component)])
+    ax.set_xlabel(r'{}/$\sigma_{{{}}}$'.format(axis, axis))
+    ax.set_ylabel(r'${}_{{{}}}$'.format(*component.split('_')))
+    if derivative:
+        if component[0] != 'E':
+            raise ValueError('derivative=True needs an E component')
+        values = [bunch.compute_E_derivative(*p, _AXES[component[2]], k).value for p in zip(*points)]
+        ax_twin = ax.twinx()
+        ax_twin.tick_params(axis='y', colors='red')
+        ax_twin.plot(line / sigma, values, c='red')
+        ax_twin.set_ylabel("$E^{{'}}_{{{}}}$".format(component[2]), color='red')
+    return ax
@@ -0,0 +1,150 @@
+import itertools
+import json
+import os
+import numpy as np
+'''
+Export of large 3D field maps of a Gaussian_Bunch to chunked, compressed HDF5 (h5py) or Zarr stores.
+The grid x * y * z is cut into blocks that match the storage chunks. Blocks are evaluated one at a time by a generator
+and written as soon as they are done, so memory use is set by the block size and not by the grid size. Every finished
+block is marked in a 'done' array of the store, an interrupted export called again with the same arguments only
+computes the blocks that are missing.
+    export_field_map(bunch, 'map.h5', x, y, z)
+    export_field_map(bunch, 'map.zarr', x, y, z, block_shape=(128, 128, 16))
+h5py and zarr are optional, only the one for the chosen format has to be installed.
+'''
+
+UNITS = {'x': 'm', 'y': 'm', 'z': 'm', 'E_x': 'V/m', 'E_y': 'V/m', 'E_z': 'V/m', 'B_x': 'T', 'B_y': 'T'}
+_COMPONENTS = ('E_x', 'E_y', 'E_z', 'B_x', 'B_y')
+
+
+def iter_field_blocks(bunch, x, y, z, block_shape=(64, 64, 64), skip=(), components=_COMPONENTS, **options):
+    '''
+    Generator over the blocks of the grid x * y * z (1D axes, indexing 'ij'), yields (index, slices, fields) with
+    the flat block index, the tuple of slices of the block in the grid and a dict component -> array of the block.
+    Blocks whose index is in skip are not evaluated. options are passed on to bunch.evaluate_fields.
+    '''
+    axes = [np.asarray(v, dtype=float) for v in (x, y, z)]
+    starts = [range(0, axis.size, n) for axis, n in zip(axes, block_shape)]
+    for index, start in enumerate(itertools.product(*starts)):
+        if index in skip:
+            continue
+        slices = tuple(slice(s, s + n) for s, n in zip(start, block_shape))
+        X, Y, Z = np.meshgrid(*(axis[sl] for axis, sl in zip(axes, slices)), indexing='ij', sparse=True)
+        fields = dict(zip(_COMPONENTS, bunch.evaluate_fields(X, Y, Z, **options)))
+        yield index, slices, {name: fields[name] for name in components}
+
+
+class _Store:
+    # the few operations of an h5py File or zarr Group used by the export
+
+    def __init__(self, path, format):
+        self.format = format
+        if format == 'hdf5':
+            import h5py
+            self.root = h5py.File(path, 'a')
+        elif format == 'zarr':
+            import zarr
+            self.root = zarr.open_group(path, mode='a')
+        else:
+            raise ValueError('Unknown format: {}'.format(format))
+
+    def __contains__(self, name):
+        return name in self.root
+
+    def __getitem__(self, name):
+        return self.root[name]
+
+    def __delitem__(self, name):
+        del self.root[name]
+
+    @property
+    def attrs(self):
+        return self.root.attrs
+
+    def create(self, name, data=None, shape=None, chunks=None, dtype=None, compression='gzip'):
+        if data is not None:
+            shape, dtype = data.shape, data.dtype
+        if self.format == 'hdf5':
+            array = self.root.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks,
+                                             compression=compression, shuffle=compression is not None)
+        else:
+            # zarr compresses with its default codec
+            create = getattr(self.root, 'create_array', None) or self.root.create_dataset
+            array = create(name, shape=shape, dtype=dtype, chunks=chunks if chunks is not None else shape)
+        if data is not None:
+            array[...] = data
+        return array
+
+    def flush(self):
+        if self.format == 'hdf5':
+            self.root.flush()
+
+    def close(self):
+        if self.format == 'hdf5':
+            self.root.close()
+
+
+def _Get_metadata(bunch, axes, block_shape, components, dtype):
+    # everything the stored values depend on, compared when an existing store is resumed
+    return {'Energy': bunch.Energy, 'sigma_x': bunch.sigma_x, 'sigma_y': bunch.sigma_y, 'sigma_z': bunch.sigma_z,
+            'Number_e': bunch.Number_e, 'gam': bunch.gam, 'beta': bunch.beta, 'mass_e': bunch.mass_e,
+            'shape': [axis.size for axis in axes], 'block_shape': list(block_shape), 'components': list(components),
+            'dtype': np.dtype(dtype).name, 'units': UNITS}
+
+
+def export_field_map(bunch, path, x, y, z, block_shape=(64, 64, 64), format=None, components=_COMPONENTS[:3],
+                     dtype='float64', compression='gzip', **options):
+    '''
+    Writes the fields of bunch on the grid x * y * z (1D axes in m) to path and returns the number of blocks
+    computed by this call (0 if the store was already complete).
+    format: 'hdf5' or 'zarr', by default taken from the extension (.zarr is Zarr, anything else HDF5),
+    components: any of E_x, E_y, E_z, B_x, B_y (B follows from E, B_x = beta/c*E_y, B_y = -beta/c*E_x),
+    dtype: storage type, e.g. 'float32' for visualization, compression: HDF5 filter (zarr uses its default codec),
+    options: passed on to bunch.evaluate_fields.
+    The axes are stored as 1D arrays 'x', 'y', 'z', the fields as 3D arrays, the bunch parameters, grid and units
+    as the JSON attribute 'metadata' of the root.
+    '''
+    if format is None:
+        format = 'zarr' if path.rstrip(os.sep).endswith('.zarr') else 'hdf5'
+    axes = [np.asarray(v, dtype=float).ravel() for v in (x, y, z)]
+    shape = tuple(axis.size for axis in axes)
+    block_shape = tuple(min(n, size) for n, size in zip(block_shape, shape))
+    n_blocks = int(np.prod([-(-size // n) for size, n in zip(shape, block_shape)]))
+    metadata = json.dumps(_Get_metadata(bunch, axes, block_shape, components, dtype), sort_keys=True)
+
+    store = _Store(path, format)
+    try:
+        names = ('x', 'y', 'z', 'done') + tuple(components)
+        if store.attrs.get('metadata', metadata) != metadata or \
+                ('metadata' not in store.attrs and any(name in store for name in names)) or \
+                ('done' in store and not all(np.array_equal(store[name][...], axis)
+                                             for name, axis in zip('xyz', axes))):
+            raise ValueError('{} holds a different field map, remove it or choose another path'.format(path))
+        if 'done' not in store:
+            # the metadata goes first and 'done' last, so an interrupted setup is recognized as ours and redone;
+            # nothing of it has been computed yet
+            store.attrs['metadata'] = metadata
+            for name in names:
+                if name in store:
+                    del store[name]
+            for name, axis in zip('xyz', axes):
+                store.create(name, data=axis, compression=None)
+            for name in components:
+                store.create(name, shape=shape, chunks=block_shape, dtype=dtype, compression=compression)
+            store.create('done', data=np.zeros(n_blocks, dtype=np.uint8), compression=None)
+            store.flush()
+
+        done = store['done']
+        finished = set(np.flatnonzero(done[...]).tolist())
+        computed = 0
+        for index, slices, fields in iter_field_blocks(bunch, *axes, block_shape=block_shape, skip=finished,
+                                                       components=components, **options):
+            for name in components:
+                store[name][slices] = fields[name].astype(dtype, copy=False)
+            # the block counts as done only after its values are written
+            done[index] = 1
+            store.flush()
+            computed += 1
+        return computed
+    finally:
+        store.close()
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+import numpy as np
+from scipy import constants
+from scipy import interpolate
+'''
+Tabulated field map of a Gaussian_Bunch for repeated queries.
+The fields are tabulated once on a grid in units of sigma (x/sigma_x, y/sigma_y, z/sigma_z) and then answered by cubic
+interpolation. Only the positive octant is stored, E_x, E_y, E_z are odd in x, y, z and even in the other coordinates.
+The table holds the field of one electron (fields are linear in Number_e), so the same table serves every intensity
+and is stored on disk under a hash of the remaining bunch parameters.
+'''
+
+
+def _Get_key(bunch, extent, tol, max_nodes):
+    # everything the normalized table depends on, Number_e is left out on purpose
+    text = repr((Field_Map.version, bunch.mass_e, bunch.Energy, bunch.sigma_x, bunch.sigma_y, bunch.sigma_z,
+                 tuple(float(v) for v in extent), tol, max_nodes))
+    return hashlib.sha1(text.encode()).hexdigest()[:20]
+
+
+def _Write_atomic(path, save):
+    # save(file) into a temporary file next to path, renamed to path only once it is complete
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            save(f)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+class Field_Map:
+    version = 1
+
+    def __init__(self, bunch, extent=(8, 8, 8), tol=1e-4, max_nodes=129, cache_dir=None):
+        '''
+        bunch: Gaussian_Bunch to tabulate, extent: half size of the map in units of (sigma_x, sigma_y, sigma_z),
+        tol: target interpolation error relative to the peak field, max_nodes: node limit per axis,
+        cache_dir: directory for the .npy tables, None keeps the map in memory only.
+        '''
+        self.bunch = bunch
+        self.extent = tuple(float(v) for v in extent)
+        self.tol = tol
+        self.max_nodes = max_nodes
+        self.cache_dir = cache_dir
+
+        path = self.__Get_cache_path()
+        if path is None or not self.__Load(path):
+            self.__Build()
+            if path is not None:
+                self.__Save(path)
+        self.__interpolators = [interpolate.RegularGridInterpolator(self.__axes, self.__values[i], method='cubic')
+                                for i in range(3)]
+
+    def __Load(self, path):
+        # False if the cached map is missing or unreadable (e.g. left behind by a killed process), it is rebuilt then
+        try:
+            with np.load(path + '_axes.npz') as data:
+                axes = [data['u'], data['v'], data['w']]
+                error_bound = float(data['error_bound'])
+            values = np.load(path + '.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return False
+        if values.shape != (3,) + tuple(axis.size for axis in axes):
+            return False
+        self.__axes, self.__values, self.__error_bound = axes, values, error_bound
+        return True
+
+    def __Save(self, path):
+        # axes first and the table last, each written to a temporary file and renamed into place, so a table that
+        # exists is complete and other processes never map a file that is still being written
+        os.makedirs(self.cache_dir, exist_ok=True)
+        _Write_atomic(path + '_axes.npz', lambda f: np.savez(f, u=self.__axes[0], v=self.__axes[1], w=self.__axes[2],
+                                                             error_bound=self.__error_bound))
+        _Write_atomic(path + '.npy', lambda f: np.save(f, self.__values))
+
+    @property
+    def key(self):
+        return _Get_key(self.bunch, self.extent, self.tol, self.max_nodes)
+
+    @classmethod
+    def from_cache(cls, bunch, cache_dir, extent=(8, 8, 8), tol=1e-4, max_nodes=129):
+        # the map stored in cache_dir for these arguments, None if there is none (nothing is built);
+        # a damaged cache entry is rebuilt
+        path = os.path.join(cache_dir, 'field_map_' + _Get_key(bunch, extent, tol, max_nodes))
+        if not (os.path.exists(path + '.npy') and os.path.exists(path + '_axes.npz')):
+            return None
+        return cls(bunch, extent, tol, max_nodes, cache_dir)
+
+    def __Get_cache_path(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, 'field_map_' + self.key)
+
+    @property
+    def error_bound(self):
+        # estimate of the interpolation error relative to the peak field of the map: the largest error seen at the
+        # interval midpoints during the last refinement pass (errors between the midpoints can be somewhat larger)
+        return self.__error_bound
+
+    @property
+    def axes(self):
+        return self.__axes
+
+    def __Tabulate(self, axes):
+        bunch = self.bunch
+        U, V, W = np.meshgrid(*axes, indexing='ij')
+        E = bunch.evaluate_fields(U * bunch.sigma_x, V * bunch.sigma_y, W * bunch.sigma_z)[:3]
+        return np.array(E) / bunch.Number_e
+
+    def __Build(self):
+        # Start from a coarse grid and insert the midpoints of every interval whose cubic interpolation error,
+        # checked against the exact field at the midpoint, is above tol. Axes are refined one after the other.
+        axes = [np.linspace(0, extent, 9) for extent in self.extent]
+        values = self.__Tabulate(axes)
+        scale = np.max(np.abs(values))
+        errors = [np.inf, np.inf, np.inf]
+        while True:
+            refined = False
+            for k in range(3):
+                mid = 0.5 * (axes[k][1:] + axes[k][:-1])
+                trial_axes = list(axes)
+                trial_axes[k] = mid
+                exact = self.__Tabulate(trial_axes)
+                points = np.stack(np.meshgrid(*trial_axes, indexing='ij'), axis=-1)
+                error = np.zeros(mid.size)
+                for i in range(3):
+                    approx = interpolate.RegularGridInterpolator(axes, values[i], method='cubic')(points)
+                    error = np.maximum(error, np.moveaxis(np.abs(approx - exact[i]), k, 0)
+                                       .reshape(mid.size, -1).max(axis=1) / scale)
+                errors[k] = error.max()
+
+                bad = error > self.tol
+                if np.any(bad) and axes[k].size + np.count_nonzero(bad) <= self.max_nodes:
+                    order = np.argsort(np.concatenate([axes[k], mid[bad]]))
+                    axes[k] = np.concatenate([axes[k], mid[bad]])[order]
+                    values = np.concatenate([values, np.compress(bad, exact, axis=k + 1)], axis=k + 1)
+                    values = np.take(values, order, axis=k + 1)
+                    refined = True
+            if not refined:
+                break
+        self.__axes = axes
+        self.__values = values
+        self.__error_bound = float(max(errors))
+
+    def evaluate_fields(self, x, y, z):
+        '''
+        Same call and return values as Gaussian_Bunch.evaluate_fields (E_x, E_y, E_z, B_x, B_y), answered from the
+        table. Points outside the map are computed directly by the bunch.
+        '''
+        bunch = self.bunch
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                      np.asarray(z, dtype=float))
+        shape = x.shape
+        x, y, z = x.ravel(), y.ravel(), z.ravel()
+        points = np.stack([np.abs(x) / bunch.sigma_x, np.abs(y) / bunch.sigma_y, np.abs(z) / bunch.sigma_z], axis=-1)
+        inside = np.all(points <= self.extent, axis=1)
+
+        E = np.empty((3, x.size))
+        signs = (np.sign(x), np.sign(y), np.sign(z))
+        for i in range(3):
+            E[i, inside] = self.__interpolators[i](points[inside]) * signs[i][inside] * bunch.Number_e
+        if not np.all(inside):
+            E[:, ~inside] = bunch.evaluate_fields(x[~inside], y[~inside], z[~inside])[:3]
+
+        E_x, E_y, E_z = (v.reshape(shape) for v in E)
+        return E_x, E_y, E_z, bunch.beta / constants.c * E_y, -bunch.beta / constants.c * E_x
@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import json
+from collections import OrderedDict
+import numpy as np
+from GaussianBunchField import Gaussian_Bunch
+from FieldMap import Field_Map
+'''
+asyncio server for the fields of Gaussian bunches, for interactive tools with many clients asking for a few points.
+Requests for the same bunch that arrive within a short window are merged into one vectorized evaluate_fields call.
+Bunches are kept warm per parameter set, and points inside a registered or cached Field_Map are answered from the
+map before anything is integrated.
+The protocol is one JSON object per line over a Unix socket or TCP:
+    request:  {"id": 1, "bunch": {"Energy": ..., "sigma_x": ..., "sigma_y": ..., "sigma_z": ..., "Number_e": ...},
+               "x": [...], "y": [...], "z": [...], "exact": false}
+    response: {"id": 1, "E_x": [...], "E_y": [...], "E_z": [...], "B_x": [...], "B_y": [...]} or {"id": 1, "error": "..."}
+"exact": true skips the field maps. Run with
+    python FieldServer.py --unix /tmp/bunch_field.sock --map-dir maps
+    python FieldServer.py --port 8765
+'''
+
+_PARAMETERS = ('Energy', 'sigma_x', 'sigma_y', 'sigma_z', 'Number_e')
+_FIELDS = ('E_x', 'E_y', 'E_z', 'B_x', 'B_y')
+
+
+def _Check_parameters(parameters):
+    # (Energy, sigma_x, sigma_y, sigma_z, Number_e) as floats, rejected before they reach a batch
+    parameters = tuple(float(v) for v in parameters)
+    if len(parameters) != len(_PARAMETERS):
+        raise ValueError('expected the bunch parameters {}'.format(', '.join(_PARAMETERS)))
+    if not all(np.isfinite(parameters)):
+        raise ValueError('bunch parameters must be finite')
+    if parameters[0] < Gaussian_Bunch.mass_e:
+        raise ValueError('Energy must be at least the electron rest energy {} eV'.format(Gaussian_Bunch.mass_e))
+    if min(parameters[1:4]) <= 0:
+        raise ValueError('sigma_x, sigma_y and sigma_z must be positive')
+    return parameters
+
+
+class Field_Server:
+
+    def __init__(self, window=0.002, max_batch=65536, max_bunches=32, map_dir=None, **options):
+        '''
+        window: seconds a request waits for others of the same bunch, max_batch: points that flush a batch at once,
+        max_bunches: warm bunches (and field maps found in map_dir) kept, least recently used first out,
+        map_dir: directory searched for cached Field_Map tables (default map arguments),
+        options: passed on to Gaussian_Bunch.evaluate_fields.
+        '''
+        self.window = window
+        self.max_batch = max_batch
+        self.max_bunches = max_bunches
+        self.map_dir = map_dir
+        self.options = options
+        self.__bunches = OrderedDict()
+        self.__maps = {}  # looked up in map_dir for the warm bunches, evicted with them
+        self.__registered_maps = {}  # from add_field_map, kept until the server goes away
+        self.__pending = {}
+        self.n_requests = 0
+        self.n_batches = 0
+
+    def add_field_map(self, field_map):
+        # answer points of bunches with the energy and sigmas of field_map from the map, any Number_e
+        bunch = field_map.bunch
+        self.__registered_maps[(bunch.Energy, bunch.sigma_x, bunch.sigma_y, bunch.sigma_z)] = field_map
+
+    def __Get_bunch(self, key):
+        if key not in self.__bunches:
+            self.__bunches[key] = Gaussian_Bunch(*key)
+            shape = key[:4]
+            if self.map_dir is not None and shape not in self.__maps and shape not in self.__registered_maps:
+                self.__maps[shape] = Field_Map.from_cache(self.__bunches[key], self.map_dir)
+            if len(self.__bunches) > self.max_bunches:
+                old, _ = self.__bunches.popitem(last=False)
+                if not any(other[:4] == old[:4] for other in self.__bunches):
+                    self.__maps.pop(old[:4], None)
+        self.__bunches.move_to_end(key)
+        return self.__bunches[key]
+
+    def __Evaluate(self, bunch, field_map, x, y, z):
+        # runs in a worker thread, the event loop keeps accepting requests meanwhile
+        if field_map is None:
+            return np.array(bunch.evaluate_fields(x, y, z, **self.options))
+        return np.array(field_map.evaluate_fields(x, y, z)) * (bunch.Number_e / field_map.bunch.Number_e)
+
+    def __Dispatch(self, key):
+        # takes the pending batch of key out of the queue (later requests start a new one) and evaluates it
+        batch = self.__pending.pop(key, None)
+        if batch is not None:
+            batch['timer'].cancel()
+            asyncio.ensure_future(self.__Flush(key, batch))
+
+    async def __Flush(self, key, batch):
+        # every future of the batch gets a result or the exception, whatever fails
+        sizes = [len(points[0]) for points, _ in batch['requests']]
+        x, y, z = (np.concatenate([points[i] for points, _ in batch['requests']]) for i in range(3))
+        self.n_batches += 1
+        try:
+            bunch = self.__Get_bunch(key[0])
+            field_map = None if key[1] else self.__registered_maps.get(key[0][:4], self.__maps.get(key[0][:4]))
+            fields = await asyncio.get_running_loop().run_in_executor(None, self.__Evaluate, bunch, field_map,
+                                                                      x, y, z)
+        except Exception as error:
+            for _, future in batch['requests']:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), part in zip(batch['requests'], np.split(fields, np.cumsum(sizes)[:-1], axis=1)):
+            if not future.done():
+                future.set_result(part)
+
+    async def evaluate_fields(self, parameters, x, y, z, exact=False):
+        '''
+        E_x, E_y, E_z, B_x, B_y as an array (5, n) at the points x, y, z (1D, same length) of the bunch with
+        parameters (Energy, sigma_x, sigma_y, sigma_z, Number_e), merged with concurrent requests for that bunch.
+        '''
+        key = (_Check_parameters(parameters), bool(exact))
+        points = [np.asarray(v, dtype=float).ravel() for v in (x, y, z)]
+        if not points[0].size == points[1].size == points[2].size:
+            raise ValueError('x, y and z must have the same length')
+        self.n_requests += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.__pending.get(key)
+        if batch is None:
+            batch = self.__pending[key] = {'requests': [], 'size': 0,
+                                           'timer': loop.call_later(self.window, self.__Dispatch, key)}
+        batch['requests'].append((points, future))
+        batch['size'] += points[0].size
+        if batch['size'] >= self.max_batch:
+            self.__Dispatch(key)
+        return await future
+
+    async def __Handle(self, reader, writer):
+        # one connection, requests are answered in the order their batches finish
+        tasks = set()
+
+        async def answer(request):
+            try:
+                parameters = [request['bunch'][name] for name in _PARAMETERS]
+                fields = await self.evaluate_fields(parameters, request['x'], request['y'], request['z'],
+                                                    request.get('exact', False))
+                response = {'id': request.get('id'), **{name: v.tolist() for name, v in zip(_FIELDS, fields)}}
+            except Exception as error:
+                response = {'id': request.get('id'), 'error': '{}: {}'.format(type(error).__name__, error)}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('expected a JSON object, got {}'.format(type(request).__name__))
+                except ValueError as error:
+                    writer.write(json.dumps({'id': None, 'error': 'bad request: {}'.format(error)}).encode() + b'\n')
+                    continue
+                task = asyncio.ensure_future(answer(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        # listens on the Unix socket path, or on host:port (port 0 picks a free port, see server.sockets)
+        if path is not None:
+            return await asyncio.start_unix_server(self.__Handle, path, limit=2 ** 26)
+        return await asyncio.start_server(self.__Handle, host, port, limit=2 ** 26)
+
+
+class Field_Client:
+    # asyncio client, several requests can be in flight on one connection
+
+    def __init__(self, reader, writer):
+        self.__reader = reader
+        self.__writer = writer
+        self.__futures = {}
+        self.__next_id = 0
+        self.__receiver = asyncio.ensure_future(self.__Receive())
+
+    @classmethod
+    async def connect(cls, path=None, host='127.0.0.1', port=8765):
+        if path is not None:
+            return cls(*await asyncio.open_unix_connection(path, limit=2 ** 26))
+        return cls(*await asyncio.open_connection(host, port, limit=2 ** 26))
+
+    async def __Receive(self):
+        while True:
+            line = await self.__reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self.__futures.pop(response['id'], None)
+            if future is None or future.done():
+                continue
+            if 'error' in response:
+                future.set_exception(RuntimeError(response['error']))
+            else:
+                future.set_result(tuple(np.array(response[name]) for name in _FIELDS))
+        for future in self.__futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError('connection to the field server closed'))
+
+    async def evaluate_fields(self, bunch, x, y, z, exact=False):
+        # E_x, E_y, E_z, B_x, B_y of the Gaussian_Bunch bunch at the points x, y, z, computed by the server
+        self.__next_id += 1
+        request_id = self.__next_id
+        future = asyncio.get_running_loop().create_future()
+        self.__futures[request_id] = future
+        request = {'id': request_id, 'bunch': {name: getattr(bunch, name) for name in _PARAMETERS},
+                   'x': np.atleast_1d(x).tolist(), 'y': np.atleast_1d(y).tolist(), 'z': np.atleast_1d(z).tolist(),
+                   'exact': exact}
+        self.__writer.write(json.dumps(request).encode() + b'\n')
+        await self.__writer.drain()
+        return await future
+
+    async def close(self):
+        self.__writer.close()
+        await self.__writer.wait_closed()
+        await self.__receiver
+
+
+def main():
+    parser = argparse.ArgumentParser(description='asyncio server for Gaussian_Bunch fields')
+    parser.add_argument('--unix', help='Unix socket path, otherwise TCP on --host/--port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window', type=float, default=0.002, help='batching window in seconds')
+    parser.add_argument('--map-dir', help='directory with cached Field_Map tables')
+    parser.add_argument('--engine', default='auto', help='engine of Gaussian_Bunch.evaluate_fields')
+    args = parser.parse_args()
+
+    async def serve():
+        server = await Field_Server(args.window, map_dir=args.map_dir, engine=args.engine).start(
+            args.unix, args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
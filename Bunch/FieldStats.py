@@ -0,0 +1,130 @@
+import copy
+import heapq
+import json
+import threading
+import time
+'''
+Opt-in instrumentation of the Gaussian_Bunch hot paths.
+While a Field_Stats is active, every quad of the scalar methods (compute_E / Get_E_*, compute_E_derivative), every
+fields_at and every evaluate_fields call is recorded: calls, wall time, quad calls, integrand evaluations (nodes of the
+fixed rules), quad subintervals, status codes, evaluation paths and the most expensive points. When nothing is active
+the hot paths only test one module attribute.
+    with collect_stats() as stats:
+        bunch.Get_E_x(x, y, z)
+    print(stats.as_dict())
+    stats.to_chrome_trace('trace.json')  # chrome://tracing or https://ui.perfetto.dev
+'''
+
+active = None  # the Field_Stats being collected, None when instrumentation is off
+
+_PATH_NAMES = ('quadrature', 'symmetry', 'flat_bunch', 'round_axis', 'refined')
+_STATUS_NAMES = ('ok', 'inaccurate', 'quad_warning')
+
+
+class Field_Stats:
+
+    def __init__(self, trace=False, n_worst=20):
+        '''
+        trace: also keep one event per call for to_chrome_trace, n_worst: number of most expensive scalar calls
+        (by integrand evaluations) kept with their point and bunch parameters.
+        '''
+        self.trace = trace
+        self.n_worst = n_worst
+        self.methods = {}
+        self.paths = {name: dict.fromkeys(_PATH_NAMES, 0) for name in ('E_x', 'E_y', 'E_z')}
+        self.events = []
+        self.__worst = []
+        self.__count = 0
+        self.__lock = threading.Lock()
+        self.__start = time.perf_counter()
+
+    def record(self, method, start, seconds, quad_calls=0, integrand_evaluations=0, subintervals=0, status=None,
+               points=1, point=None, bunch=None):
+        # one call of method that started at time.perf_counter() = start and took seconds
+        with self.__lock:
+            entry = self.methods.get(method)
+            if entry is None:
+                entry = self.methods[method] = {'calls': 0, 'points': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                'quad_calls': 0, 'integrand_evaluations': 0, 'subintervals': 0,
+                                                'status': dict.fromkeys(_STATUS_NAMES, 0)}
+            integrand_evaluations = int(integrand_evaluations)
+            entry['calls'] += 1
+            entry['points'] += int(points)
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['quad_calls'] += quad_calls
+            entry['integrand_evaluations'] += integrand_evaluations
+            entry['subintervals'] += int(subintervals)
+            if status is not None:
+                entry['status'][_STATUS_NAMES[status]] += 1
+
+            if point is not None and self.n_worst > 0:
+                self.__count += 1
+                item = (integrand_evaluations, seconds, self.__count, method, tuple(float(v) for v in point),
+                        None if bunch is None else (bunch.Energy, bunch.sigma_x, bunch.sigma_y, bunch.sigma_z))
+                if len(self.__worst) < self.n_worst:
+                    heapq.heappush(self.__worst, item)
+                else:
+                    heapq.heappushpop(self.__worst, item)
+            if self.trace:
+                self.events.append({'name': method, 'ph': 'X', 'pid': 0, 'tid': threading.get_ident(),
+                                    'ts': (start - self.__start) * 1e6, 'dur': seconds * 1e6,
+                                    'args': {'integrand_evaluations': integrand_evaluations, 'points': int(points)}})
+
+    def record_paths(self, path):
+        # path: PATH_* codes (3, ...) of an evaluate_fields call
+        with self.__lock:
+            for name, codes in zip(('E_x', 'E_y', 'E_z'), path):
+                for code, path_name in enumerate(_PATH_NAMES):
+                    self.paths[name][path_name] += int((codes == code).sum())
+
+    @property
+    def worst(self):
+        # most expensive scalar calls, largest integrand evaluation count first
+        return [{'method': method, 'integrand_evaluations': n, 'seconds': seconds, 'point': point,
+                 'bunch': dict(zip(('Energy', 'sigma_x', 'sigma_y', 'sigma_z'), bunch)) if bunch else None}
+                for n, seconds, _, method, point, bunch in sorted(self.__worst, reverse=True)]
+
+    def as_dict(self):
+        with self.__lock:
+            return {'methods': copy.deepcopy(self.methods), 'paths': copy.deepcopy(self.paths), 'worst': self.worst}
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+    def to_chrome_trace(self, path):
+        # Trace Event Format, needs trace=True
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+
+def enable_stats(trace=False, n_worst=20):
+    # starts collecting into a new Field_Stats and returns it
+    global active
+    active = Field_Stats(trace, n_worst)
+    return active
+
+
+def disable_stats():
+    global active
+    stats, active = active, None
+    return stats
+
+
+class collect_stats:
+    # context manager around enable_stats / disable_stats, restores the previously active Field_Stats on exit
+
+    def __init__(self, trace=False, n_worst=20):
+        self.trace = trace
+        self.n_worst = n_worst
+
+    def __enter__(self):
+        global active
+        self.__previous = active
+        active = Field_Stats(self.trace, self.n_worst)
+        return active
+
+    def __exit__(self, *exc):
+        global active
+        active = self.__previous
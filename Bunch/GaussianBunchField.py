@@ -1,16 +1,117 @@
-import matplotlib.pyplot as plt
+from collections import namedtuple
+import time
 import numpy as np
-from scipy import constants
-from scipy import integrate
 import warnings
+import FieldStats
+from IntegrandKernels import get_integrand
 '''
 This code can be used for calculating the field of a Gaussian bunch,which can theoretically calculate the field- 
 -generated by bunches of any size at any position, but, for extreme parameters, there may be some integration errors.
 About the specific method, I calculate the value of the electric field using the scalar potential in the co-moving system,
 and then transform it back into the laboratory system.
 This code uses the SI units.
+Only numpy is needed at import time, scipy.integrate and scipy.special are imported by the functions that use them
+and plotting lives in BunchPlot.py, so short-lived worker processes start quickly.
+Call counts, quad statistics and timings are recorded while a FieldStats.Field_Stats is active (see FieldStats.py).
 '''
 
+# exact SI values, taken as literals so that scipy.constants is not imported
+elementary_charge = 1.602176634e-19
+speed_of_light = 299792458.0
+
+
+def exp_sinh_rule(n_nodes, s_max=4.0):
+    # Fixed exp-sinh (double exponential) rule on [0, inf): q = exp(pi/2 * sinh(s)), trapezoid in s.
+    # Nodes and weights are returned for a unit scale, multiply both by the scale of q.
+    s = np.linspace(-s_max, s_max, n_nodes)
+    h = s[1] - s[0]
+    nodes = np.exp(np.pi / 2 * np.sinh(s))
+    weights = h * np.pi / 2 * np.cosh(s) * nodes
+    return nodes, weights
+
+
+# which evaluation path produced a field component, see Gaussian_Bunch.evaluate_fields
+PATH_QUADRATURE = 0  # general 3D case, q integral done numerically
+PATH_SYMMETRY = 1  # point on the symmetry plane of this component, exactly zero
+PATH_FLAT_BUNCH = 2  # gam*sigma_z >> sigma_x, sigma_y: 2D transverse field times the line charge density
+PATH_ROUND_AXIS = 3  # E_z on the axis of a round beam, closed form with erf and Owen's T function
+PATH_REFINED = 4  # engine='vector': error estimate of the fixed rule above tol, redone by adaptive quad
+
+# bytes of the (points x nodes) block of engine='vector', about the size of a per-core L2 cache
+BLOCK_BYTES = 1 << 19
+
+
+def transverse_field_2d(x, y, sigma_x, sigma_y):
+    # Field of a 2D Gaussian line charge of unit density divided by 1/epsilon_0, i.e. E*epsilon_0/lambda.
+    # Round beams use the elementary formula, elliptical beams the Bassetti-Erskine formula with the
+    # Faddeeva function, evaluated in the first quadrant and mirrored.
+    from scipy import special
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if sigma_x == sigma_y:
+        r2 = x ** 2 + y ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f = np.where(r2 > 0, -np.expm1(-r2 / (2 * sigma_x ** 2)) / r2, 1 / (2 * sigma_x ** 2))
+        return f * x / (2 * np.pi), f * y / (2 * np.pi)
+    if sigma_y > sigma_x:
+        E_y, E_x = transverse_field_2d(y, x, sigma_y, sigma_x)
+        return E_x, E_y
+    S = (2 * (sigma_x ** 2 - sigma_y ** 2)) ** 0.5
+    ax = np.abs(x)
+    ay = np.abs(y)
+    w = special.wofz((ax + 1j * ay) / S) - \
+        np.exp(-ax ** 2 / (2 * sigma_x ** 2) - ay ** 2 / (2 * sigma_y ** 2)) * \
+        special.wofz((ax * sigma_y / sigma_x + 1j * ay * sigma_x / sigma_y) / S)
+    factor = 1 / (2 * np.pi ** 0.5 * S)
+    return np.sign(x) * factor * w.imag, np.sign(y) * factor * w.real
+
+
+def round_axis_E_z_integral(z_rest, b, c):
+    # q integral of the E_z integrand at x = y = 0 for a round beam, b = 2*sigma_r^2 > c = 2*(gam*sigma_z)^2.
+    # With t = z/sqrt(q + c) it becomes 4/d * int_0^T t^2 exp(-t^2) / (t^2 + a^2) dt, d = b - c.
+    from scipy import special
+    z_abs = np.abs(z_rest)
+    d = b - c
+    T = z_abs / c ** 0.5
+    a = z_abs / d ** 0.5
+    # int_0^T exp(-t^2) / (t^2 + a^2) dt = 2*pi/a * exp(a^2) * T_owen(sqrt(2)*a, T/a), and T/a = sqrt(d/c)
+    tail = 2 * np.pi * a * np.exp(a ** 2) * special.owens_t(2 ** 0.5 * a, (d / c) ** 0.5)
+    return np.sign(z_rest) * 4 / d * (np.pi ** 0.5 / 2 * special.erf(T) - tail)
+
+
+# value and quad error estimate (SI units) of one field quantity with a status code, see Gaussian_Bunch.compute_E
+Field_Result = namedtuple('Field_Result', ['value', 'error', 'status'])
+STATUS_OK = 0
+STATUS_INACCURATE = 1  # error estimate above 1% of the value
+STATUS_QUAD_WARNING = 2  # quad reported a problem (subdivision limit, roundoff, ...), value may be unreliable
+
+
+class Bunch_Field_Warning(UserWarning):
+    # integration problems in the scalar getters, a warning instead of a print so that worker processes and
+    # callers can filter it or turn it into an error
+    pass
+
+
+def _Fold_points(points):
+    # distinct points of |points| (3, n) and the index of each original point among them; the coordinates are
+    # numbered per axis first, so the 3D deduplication is a 1D unique over integer keys
+    codes = []
+    axes = []
+    for v in np.abs(points):
+        values, code = np.unique(v, return_inverse=True)
+        axes.append(values)
+        codes.append(code.ravel().astype(np.int64))
+    if np.prod([float(values.size) for values in axes]) >= 2 ** 63:
+        octant, inverse = np.unique(np.abs(points), axis=1, return_inverse=True)
+        return octant, inverse.ravel()
+    keys = (codes[0] * axes[1].size + codes[1]) * axes[2].size + codes[2]
+    keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return np.stack([values[code[first]] for values, code in zip(axes, codes)]), inverse.ravel()
+
+
+# (component, axis) pairs of the symmetric rest frame Hessian, in the order used by fields_at
+_JACOBIAN_PAIRS = ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2))
+
 
 class Gaussian_Bunch:
     mass_e = 0.511E6  # [MeV]
@@ -25,117 +126,378 @@ class Gaussian_Bunch:
         self.gam = Energy / Gaussian_Bunch.mass_e
         self.beta = (1 - 1 / (self.gam ** 2)) ** (0.5)
 
-    def __E_y_fun(self, q, x, y, z, sigma_x, sigma_y, sigma_z, gam):
-        up = np.exp(-x ** 2 / (q + 2 * sigma_x ** 2)) \
-             * np.exp(-y ** 2 / (q + 2 * sigma_y ** 2)) \
-             * np.exp(-(z * gam) ** 2 / (q + 2 * (sigma_z * gam) ** 2)) \
-             * 2 * y * gam / (q + 2 * sigma_y ** 2)
-
-        down = (q + 2 * sigma_x ** 2) ** 0.5 * \
-               (q + 2 * sigma_y ** 2) ** 0.5 * \
-               (q + 2 * (sigma_z * gam) ** 2) ** 0.5
-
-        return up / down
-
-    def __E_x_fun(self, q, x, y, z, sigma_x, sigma_y, sigma_z, gam):
-        up = np.exp(-x ** 2 / (q + 2 * sigma_x ** 2)) \
-             * np.exp(-y ** 2 / (q + 2 * sigma_y ** 2)) \
-             * np.exp(-(z * gam) ** 2 / (q + 2 * (sigma_z * gam) ** 2)) \
-             * 2 * x * gam / (q + 2 * sigma_x ** 2)
-
-        down = (q + 2 * sigma_x ** 2) ** 0.5 * \
-               (q + 2 * sigma_y ** 2) ** 0.5 * \
-               (q + 2 * (sigma_z * gam) ** 2) ** 0.5
-
-        return up / down
-
-    def __E_z_fun(self, q, x, y, z, sigma_x, sigma_y, sigma_z, gam):
-        up = np.exp(- x ** 2 / (q + 2 * sigma_x ** 2)
-                    - y ** 2 / (q + 2 * sigma_y ** 2)
-                    - (z * gam) ** 2 / (q + 2 * (sigma_z * gam) ** 2)) \
-             * 2 * gam * z / (q + 2 * (gam * sigma_z) ** 2)
-
-        down = ((q + 2 * sigma_x ** 2) * \
-                (q + 2 * sigma_y ** 2) * \
-                (q + 2 * (gam * sigma_z) ** 2)) ** 0.5
-
-        return up / down
-
-    def __Get_q_limit(self, x, y, z):
-        x = np.abs(x)
-        y = np.abs(y)
-        z = np.abs(z)
-        if x / self.sigma_x > 50 and y / self.sigma_y < 50 and z / self.sigma_z < 50:
-            return 40 * x
-        elif x / self.sigma_x < 50 and y / self.sigma_y > 50 and z / self.sigma_z < 50:
-            return 40 * y
-        elif x / self.sigma_x > 50 and y / self.sigma_y < 50:
-            return (1e3 * x) ** 2 * (1e3 * z) ** 2
-        elif x / self.sigma_x < 50 and y / self.sigma_y > 50:
-            return (1e3 * y) ** 2 * (1e3 * z) ** 2
+    def __getstate__(self):
+        # only the bunch parameters travel to other processes, not the results of the last Get_* call
+        return {'Energy': self.Energy, 'sigma_x': self.sigma_x, 'sigma_y': self.sigma_y, 'sigma_z': self.sigma_z,
+                'Number_e': self.Number_e, 'gam': self.gam, 'beta': self.beta}
+
+    def __Get_q_scale(self):
+        # geometric mean of the smallest and largest 2*sigma^2, centres the exp-sinh nodes on the bunch
+        b = 2 * np.array([self.sigma_x, self.sigma_y, self.sigma_z * self.gam]) ** 2
+        return (b.min() * b.max()) ** 0.5
+
+    def __Batch_quadrature(self, x, y, z_rest, n_nodes, chunk_size):
+        # raw q integrals of the E_x, E_y, E_z integrands for flat arrays of points (z in the rest frame)
+        q_scale = self.__Get_q_scale()
+        nodes, weights = exp_sinh_rule(n_nodes)
+        q = q_scale * nodes
+        inv_a_x = 1 / (q + 2 * self.sigma_x ** 2)
+        inv_a_y = 1 / (q + 2 * self.sigma_y ** 2)
+        inv_a_z = 1 / (q + 2 * (self.sigma_z * self.gam) ** 2)
+        weights = q_scale * weights * (inv_a_x * inv_a_y * inv_a_z) ** 0.5
+
+        I_x = np.empty(x.size)
+        I_y = np.empty(x.size)
+        I_z = np.empty(x.size)
+        for start in range(0, x.size, chunk_size):
+            sl = slice(start, start + chunk_size)
+            kernel = np.exp(-np.multiply.outer(x[sl] ** 2, inv_a_x)
+                            - np.multiply.outer(y[sl] ** 2, inv_a_y)
+                            - np.multiply.outer(z_rest[sl] ** 2, inv_a_z)) * weights
+            I_x[sl] = 2 * x[sl] * self.gam * (kernel @ inv_a_x)
+            I_y[sl] = 2 * y[sl] * self.gam * (kernel @ inv_a_y)
+            I_z[sl] = 2 * z_rest[sl] * (kernel @ inv_a_z)
+        return I_x, I_y, I_z
+
+    def __Vector_quadrature(self, x, y, z_rest, n_nodes, dtype, block_bytes):
+        # Raw q integrals of the E_x, E_y, E_z integrands for flat arrays of points (z in the rest frame) and the
+        # difference |I_h - I_2h| to the same rule with every other node (n_nodes odd keeps both ends).
+        # Lengths are measured in sqrt(q_scale), so the block can be computed in float32 without overflow.
+        # The exponent of a whole block is one matrix product (points x 3) @ (3 x nodes) and the fine and coarse
+        # sums of all three components a second one (points x nodes) @ (nodes x 6).
+        q_scale = self.__Get_q_scale()
+        b = 2 * np.array([self.sigma_x, self.sigma_y, self.sigma_z * self.gam]) ** 2 / q_scale
+        r = np.stack([x, y, z_rest]) / q_scale ** 0.5
+        s_max = max(4, np.arcsinh(2 / np.pi * np.log(1e12 * max(b.max(), np.max(r ** 2)))))
+        nodes, weights = exp_sinh_rule(n_nodes, s_max)
+        inv_a = 1 / (nodes + b[:, None])
+        weights = weights * np.prod(inv_a, axis=0) ** 0.5
+        coarse = np.zeros(n_nodes)
+        coarse[::2] = 2 * weights[::2]
+        sums = np.empty((n_nodes, 6))
+        sums[:, 0::2] = (inv_a * weights).T
+        sums[:, 1::2] = (inv_a * coarse).T
+        inv_a = inv_a.astype(dtype)
+        sums = sums.astype(dtype)
+        r = r.astype(dtype)
+
+        I = np.empty((3, x.size))
+        error = np.empty((3, x.size))
+        rows = max(1, block_bytes // (n_nodes * np.dtype(dtype).itemsize))
+        for start in range(0, x.size, rows):
+            block = r[:, start:start + rows]
+            S = np.exp(-(block.T ** 2 @ inv_a)) @ sums
+            I[:, start:start + rows] = 2 * block * S[:, 0::2].T
+            error[:, start:start + rows] = np.abs(2 * block * (S[:, 0::2] - S[:, 1::2]).T)
+        return I / q_scale, error / q_scale
+
+    def __Evaluate_points(self, x, y, z, engine, limit_tol, n_nodes, chunk_size, dtype, tol, block_bytes):
+        # E (3, n) and PATH_* codes (3, n) for flat arrays of points
+        path = np.full((3, x.size), PATH_QUADRATURE)
+        E = np.zeros((3, x.size), dtype=dtype)
+        if engine == 'auto':
+            sigma_zr = self.sigma_z * self.gam
+            rho = np.maximum(np.maximum(np.abs(x), np.abs(y)), max(self.sigma_x, self.sigma_y)) / sigma_zr
+            with np.errstate(over='ignore'):
+                flat = rho ** 2 * np.exp(z ** 2 / (2 * self.sigma_z ** 2)) < limit_tol
+            if self.sigma_x == self.sigma_y or np.abs(self.sigma_x - self.sigma_y) > \
+                    1e-3 * max(self.sigma_x, self.sigma_y):
+                line_charge = elementary_charge * self.Number_e / ((2 * np.pi) ** 0.5 * self.sigma_z) * \
+                              np.exp(-z[flat] ** 2 / (2 * self.sigma_z ** 2))
+                E_x_2d, E_y_2d = transverse_field_2d(x[flat], y[flat], self.sigma_x, self.sigma_y)
+                E[0, flat] = line_charge * E_x_2d / Gaussian_Bunch.epsilon_0
+                E[1, flat] = line_charge * E_y_2d / Gaussian_Bunch.epsilon_0
+                path[:2, flat] = PATH_FLAT_BUNCH
+
+            b = 2 * self.sigma_x ** 2
+            c = 2 * sigma_zr ** 2
+            if self.sigma_x == self.sigma_y and b > c:
+                axis = (x == 0) & (y == 0) & (np.abs(z * self.gam) <= 10 * (b - c) ** 0.5)
+                E[2, axis] = round_axis_E_z_integral(z[axis] * self.gam, b, c) * self.__field_factor()
+                path[2, axis] = PATH_ROUND_AXIS
+
+        # E_x, E_y, E_z are odd in x, y, z: exact zeros on the symmetry planes, with either engine
+        for i, v in enumerate((x, y, z)):
+            E[i, v == 0] = 0
+            path[i, v == 0] = PATH_SYMMETRY
+
+        todo = np.any(path == PATH_QUADRATURE, axis=0)
+        if np.any(todo) and engine == 'vector':
+            # with tol the rule is evaluated at half the step, so |I_h/2 - I_h| is the error of the n_nodes rule
+            # itself and the (more accurate) I_h/2 is returned; always in float64, in float32 the difference would be
+            # rounding noise and most components would be sent to quad
+            if tol is None:
+                I, error = self.__Vector_quadrature(x[todo], y[todo], z[todo] * self.gam, n_nodes, dtype, block_bytes)
+            else:
+                I, error = self.__Vector_quadrature(x[todo], y[todo], z[todo] * self.gam, 2 * n_nodes - 1,
+                                                    np.float64, block_bytes)
+            index = np.flatnonzero(todo)
+            boost = (self.gam, self.gam, 1)
+            for i in range(3):
+                quad_points = path[i, todo] == PATH_QUADRATURE
+                E[i, index[quad_points]] = I[i, quad_points] * boost[i] * self.__field_factor()
+                if tol is not None:
+                    flagged = error[i] > tol * np.abs(I[i])
+                    for k in index[quad_points & flagged]:
+                        E[i, k] = self.__Integrate_field(('E_x', 'E_y', 'E_z')[i], x[k], y[k], z[k], i,
+                                                         epsrel=min(max(tol, 1e-13), 1.49e-8)).value
+                        path[i, k] = PATH_REFINED
+        elif np.any(todo):
+            I = self.__Batch_quadrature(x[todo], y[todo], z[todo] * self.gam, n_nodes, chunk_size)
+            for i in range(3):
+                quad_points = path[i] == PATH_QUADRATURE
+                E[i, quad_points] = I[i][quad_points[todo]] * self.__field_factor()
+        return E, path
+
+    def evaluate_fields(self, x, y, z, engine='auto', return_path=False, limit_tol=1e-8,
+                        n_nodes=257, chunk_size=4096, fold=True, dtype=np.float64, tol=None, block_bytes=BLOCK_BYTES):
+        '''
+        Vectorized field evaluation, x, y, z can be scalars, arrays or meshgrids (broadcast against each other).
+        engine='quadrature' does the q integral with a fixed exp-sinh rule shared by all points.
+        engine='auto' first uses the closed forms where they apply (see PATH_* codes) and only integrates the rest,
+        limit_tol bounds (sigma_perp / (gam*sigma_z))^2 * exp(z^2 / (2*sigma_z^2)) for the 2D flat-bunch limit.
+        engine='vector' integrates every point with the fixed rule in blocks of block_bytes, in dtype (np.float32
+        is enough for plots and halves the memory traffic). With tol set the rule is also evaluated at half the step,
+        the difference is the error of the n_nodes rule and the components where it exceeds tol relative to the
+        value are redone by adaptive quad to the relative tolerance tol (PATH_REFINED), the others get the half step
+        values. With tol the sums are done in float64 whatever dtype is, an error estimate in float32 is rounding
+        noise. The fields are returned in dtype.
+        With fold=True the points are mirrored into the positive octant and duplicates are computed once, the
+        signs are restored afterwards (E_x, E_y, E_z are odd in x, y, z and even in the other coordinates).
+        Points on a symmetry plane give exact zeros for the odd component without any integration.
+        Returns E_x, E_y, E_z, B_x, B_y with the broadcast shape of the inputs, and with return_path=True also
+        an int array of shape (3,) + shape giving the PATH_* code used for E_x, E_y and E_z at every point.
+        '''
+        if engine not in ('auto', 'quadrature', 'vector'):
+            raise ValueError('Unknown engine: {}'.format(engine))
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                      np.asarray(z, dtype=float))
+        shape = x.shape
+        points = np.stack([x.ravel(), y.ravel(), z.ravel()])
+        stats = FieldStats.active
+        if stats is not None:
+            start = time.perf_counter()
+
+        if fold and points.shape[1] > 1:
+            octant, inverse = _Fold_points(points)
+            E, path = self.__Evaluate_points(*octant, engine, limit_tol, n_nodes, chunk_size, dtype, tol,
+                                                 block_bytes)
+            n_quadrature = np.count_nonzero(np.any((path == PATH_QUADRATURE) | (path == PATH_REFINED), axis=0))
+            E = E[:, inverse] * np.sign(points).astype(E.dtype)
+            path = path[:, inverse]
         else:
-            return np.min([1e3 * self.sigma_x ** 2, 1e3 * self.sigma_y ** 2])
+            E, path = self.__Evaluate_points(*points, engine, limit_tol, n_nodes, chunk_size, dtype, tol,
+                                                 block_bytes)
+            n_quadrature = np.count_nonzero(np.any((path == PATH_QUADRATURE) | (path == PATH_REFINED), axis=0))
+
+        if stats is not None:
+            # nodes of the fixed rule per point, the quads of refined components are recorded by themselves
+            nodes = 2 * n_nodes - 1 if engine == 'vector' and tol is not None else n_nodes
+            stats.record('evaluate_fields', start, time.perf_counter() - start,
+                         integrand_evaluations=n_quadrature * nodes, points=points.shape[1])
+            stats.record_paths(path)
+
+        E_x, E_y, E_z = (v.reshape(shape) for v in E)
+        B_x = self.beta / speed_of_light * E_y
+        B_y = -self.beta / speed_of_light * E_x
+        if return_path:
+            return E_x, E_y, E_z, B_x, B_y, path.reshape((3,) + shape)
+        return E_x, E_y, E_z, B_x, B_y
+
+    def __field_factor(self):
+        return elementary_charge * self.Number_e / (np.pi) ** 0.5 * 1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
+
+    def __Get_break_points(self, x, y, z):
+        # s range and the s of the bunch and point scales (z in the rest frame) for the mapped integrals.
+        # quad splits at the break points so it cannot miss narrow features, and the upper end of s reaches
+        # 1e12 times the largest scale, the tails beyond are ~ q^(-3/2) and negligible.
+        scales = np.array([2 * self.sigma_x ** 2, 2 * self.sigma_y ** 2, 2 * (self.sigma_z * self.gam) ** 2,
+                           x ** 2, y ** 2, z ** 2])
+        q_scale = self.__Get_q_scale()
+        s_max = max(4, np.arcsinh(2 / np.pi * np.log(1e12 * scales.max() / q_scale)))
+        points = np.arcsinh(2 / np.pi * np.log(scales[scales > 0] / q_scale))
+        return s_max, np.unique(points[np.abs(points) < s_max])
+
+    def __Result(self, quad_output, factor):
+        # Field_Result from quad(..., full_output=1), which returns a message instead of warning when ier > 0
+        value, error = quad_output[0] * factor, abs(quad_output[1] * factor)
+        if len(quad_output) > 3:
+            status = STATUS_QUAD_WARNING
+        elif error > np.abs(0.01 * value):
+            status = STATUS_INACCURATE
+        else:
+            status = STATUS_OK
+        return Field_Result(value, error, status)
+
+    def __Integrate_field(self, name, x, y, z, component, axis=-1, epsrel=1.49e-8):
+        # E field component (axis=-1) or its derivative along axis at one point from a single quad of the compiled
+        # integrand over [0, inf) mapped to |s| <= s_max by q = q_scale * exp(pi/2 * sinh(s)); limit caps the number
+        # of subintervals, so the cost per point is bounded. The tolerance is purely relative (epsabs=0), the raw
+        # integrals are tiny numbers in SI units. name labels the call in FieldStats.
+        from scipy import integrate
+        stats = FieldStats.active
+        if stats is not None:
+            start = time.perf_counter()
+        s_max, points = self.__Get_break_points(x, y, z * self.gam)
+        output = integrate.quad(get_integrand(mapped=True), -s_max, s_max,
+                                args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam,
+                                      self.__Get_q_scale(), component, axis),
+                                points=points, limit=100 if axis < 0 else 200, epsabs=0, epsrel=epsrel,
+                                full_output=1)
+        result = self.__Result(output, self.__field_factor())
+        if stats is not None:
+            stats.record(name, start, time.perf_counter() - start, 1, output[2]['neval'], output[2]['last'],
+                         result.status, point=(x, y, z), bunch=self)
+        return result
+
+    def __Jet_quadrature(self, x, y, z, tol, max_level=10):
+        # q integrals of the E_x, E_y, E_z integrands followed by the 6 independent rest frame derivative integrands
+        # (xx, xy, xz, yy, yz, zz) at one point, all sharing the same exponentials and denominators. Nested exp-sinh
+        # trapezoid in s: every level halves the step and only evaluates the new nodes, until |T_h - T_2h| of every
+        # component is within tol of its own value (or at the roundoff of the sum of |integrand|).
+        # Lengths are measured in sqrt(q_scale): the fields come back divided by q_scale, the derivatives by
+        # q_scale^1.5. Returns the integrals, |T_h - T_2h|, the number of nodes and whether all components converged.
+        q_scale = self.__Get_q_scale()
+        b = 2 * np.array([self.sigma_x, self.sigma_y, self.sigma_z * self.gam]) ** 2 / q_scale
+        r = np.array([x, y, z * self.gam], dtype=float) / q_scale ** 0.5
+        s_max = max(4, np.arcsinh(2 / np.pi * np.log(1e12 * max(b.max(), np.max(r ** 2)))))
+        rows, columns = np.array(_JACOBIAN_PAIRS).T
+
+        def sums(s):
+            q = np.exp(np.pi / 2 * np.sinh(s))
+            inv_a = 1 / (q + b[:, None])
+            kernel = np.exp(-(r ** 2 @ inv_a)) * np.sqrt(np.prod(inv_a, axis=0)) * q * np.pi / 2 * np.cosh(s)
+            field = 2 * r[:, None] * inv_a * kernel
+            hessian = 2 * inv_a[rows] * kernel * (rows == columns)[:, None] - \
+                2 * field[rows] * r[columns, None] * inv_a[columns]
+            values = np.concatenate([field, hessian])
+            return values.sum(axis=1), np.abs(values).sum(axis=1)
+
+        n = 64
+        h = 2 * s_max / n
+        total, absolute = sums(np.linspace(-s_max, s_max, n + 1))
+        T = h * total
+        for level in range(max_level):
+            h /= 2
+            new_total, new_absolute = sums(-s_max + h * np.arange(1, 2 * n, 2))
+            n *= 2
+            total += new_total
+            absolute += new_absolute
+            error = np.abs(h * total - T)
+            T = h * total
+            if np.all(error <= np.maximum(tol * np.abs(T), 64 * np.finfo(float).eps * h * absolute)):
+                return T, error, n + 1, True
+        return T, error, n + 1, False
+
+    def compute_E(self, x, y, z, component):
+        '''
+        E_x, E_y or E_z (component 0, 1, 2) at (x, y, z) as a Field_Result(value, error, status).
+        Like the other compute_* methods it keeps no per-call state on the instance, so one bunch can be shared
+        between threads. Problems are reported by the status code, not by warnings.
+        '''
+        if component not in (0, 1, 2):
+            raise ValueError('component must be 0, 1 or 2')
+        return self.__Integrate_field(('E_x', 'E_y', 'E_z')[component], x, y, z, component)
+
+    def compute_B(self, x, y, z, component):
+        # B_x or B_y (component 0, 1) as a Field_Result, B_x = beta/c * E_y and B_y = -beta/c * E_x
+        if component not in (0, 1):
+            raise ValueError('component must be 0 or 1')
+        E = self.compute_E(x, y, z, 1 - component)
+        factor = (1 if component == 0 else -1) * self.beta / speed_of_light
+        return Field_Result(factor * E.value, abs(factor) * E.error, E.status)
+
+    def compute_E_derivative(self, x, y, z, component, axis):
+        '''
+        dE_component/d(axis) at (x, y, z) in the laboratory frame as a Field_Result, component and axis are
+        0, 1, 2 for x, y, z. One quadrature of the analytically differentiated integrand, no finite differences.
+        '''
+        if component not in (0, 1, 2) or axis not in (0, 1, 2):
+            raise ValueError('component and axis must be 0, 1 or 2')
+        return self.__Integrate_field('dE_{}/d{}'.format('xyz'[component], 'xyz'[axis]), x, y, z, component, axis)
+
+    def __Checked(self, result):
+        # the Get_* getters keep warning about bad integrals, the compute_* methods only set the status
+        if result.status == STATUS_QUAD_WARNING:
+            warnings.warn('Integration did not converge !', Bunch_Field_Warning)
+        elif result.status == STATUS_INACCURATE:
+            warnings.warn('Excessive integration error !', Bunch_Field_Warning)
+        return result
+
+    def Get_E_derivative(self, x, y, z, component, axis):
+        # value of compute_E_derivative
+        return self.__Checked(self.compute_E_derivative(x, y, z, component, axis)).value
+
+    def Get_E_jacobian(self, x, y, z):
+        # full 3x3 matrix dE_i/dr_j; the rest frame Hessian is symmetric, so only 6 integrals are needed
+        jacobian = np.empty((3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                jacobian[i, j] = self.Get_E_derivative(x, y, z, i, j)
+                if j != i:
+                    scale_ij = (self.gam if i < 2 else 1) * (self.gam if j == 2 else 1)
+                    scale_ji = (self.gam if j < 2 else 1) * (self.gam if i == 2 else 1)
+                    jacobian[j, i] = jacobian[i, j] * scale_ji / scale_ij
+        self.__E_jacobian = jacobian
 
-    def __Get_q_limit_for_z(self):
-        return 60 * self.sigma_z
+    @property
+    def E_jacobian(self):
+        return self.__E_jacobian
+
+    def set_E_jacobian_local(self, x, y, z):
+        self.Get_E_jacobian(x, y, z)
+
+    def fields_at(self, x, y, z, tol=1e-10):
+        '''
+        All field components and their gradients at one point from one vectorized quadrature of the 9 integrands,
+        each converged to the relative tolerance tol on its own.
+        Returns a dict with E_x, E_y, E_z, B_x, B_y, E_jacobian (3x3, dE_i/dr_j), B_jacobian (rows B_x, B_y) and
+        status (STATUS_OK, or STATUS_QUAD_WARNING if some component did not converge).
+        Nothing is stored on the instance.
+        '''
+        stats = FieldStats.active
+        if stats is not None:
+            start = time.perf_counter()
+        values, error, n_nodes, converged = self.__Jet_quadrature(x, y, z, tol)
+        status = STATUS_OK if converged else STATUS_QUAD_WARNING
+        if stats is not None:
+            # no quad call and no subintervals, the nested trapezoid only has nodes
+            stats.record('fields_at', start, time.perf_counter() - start, 0, n_nodes, 0, status,
+                         point=(x, y, z), bunch=self)
+        q_scale = self.__Get_q_scale()
+        factor = self.__field_factor()
+        boost = (self.gam, self.gam, 1)
+        E = [values[i] * boost[i] * factor / q_scale for i in range(3)]
+
+        jacobian = np.empty((3, 3))
+        for k, (i, j) in enumerate(_JACOBIAN_PAIRS):
+            hessian = values[3 + k] * factor / q_scale ** 1.5
+            jacobian[i, j] = hessian * boost[i] * (self.gam if j == 2 else 1)
+            jacobian[j, i] = hessian * boost[j] * (self.gam if i == 2 else 1)
+
+        return {'E_x': E[0], 'E_y': E[1], 'E_z': E[2],
+                'B_x': self.beta / speed_of_light * E[1],
+                'B_y': -self.beta / speed_of_light * E[0],
+                'E_jacobian': jacobian,
+                'B_jacobian': self.beta / speed_of_light * np.array([jacobian[1], -jacobian[0]]),
+                'status': status}
 
     def Get_E_z(self, x, y, z):
-        q_limit = self.__Get_q_limit_for_z()
-
-        inte_value_z = integrate.quad(self.__E_z_fun, 0, q_limit,
-                                      args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-
-        if np.abs(inte_value_z[1]) > np.abs(0.01 * inte_value_z[0]):
-            print('Excessive integration error !')
-        else:
-            compare_val = integrate.quad(self.__E_z_fun, 0, q_limit * 10,
-                                         args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-            if inte_value_z[0] == compare_val[0]:
-                self.__E_z = inte_value_z[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                             1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
-            elif np.abs((inte_value_z[0] - compare_val[0]) / inte_value_z[0]) < 0.05:
-                self.__E_z = inte_value_z[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                             1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
-            else:
-                print('Integration upper limit is too small !')
+        self.__E_z, self.__E_z_error, _ = self.__Checked(self.compute_E(x, y, z, 2))
 
     @property
     def E_z(self):
         return self.__E_z
 
+    @property
+    def E_z_error(self):
+        return self.__E_z_error
+
     def set_Ez_local(self, x, y, z):
         self.Get_E_z(x, y, z)
 
     def Get_E_z_derivative_z(self, x, y, z):
-        E_z_temp = []
-        Z_temp = []
-        for z_val in np.linspace(z, z + 0.001 * self.sigma_z, 10):
-
-            q_limit = self.__Get_q_limit_for_z()
-
-            inte_value_z = integrate.quad(self.__E_z_fun, 0, q_limit,
-                                          args=(x, y, z_val, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-
-            if np.abs(inte_value_z[1]) > np.abs(0.01 * inte_value_z[0]):
-                print('Excessive integration error !')
-
-            else:
-                compare_val = integrate.quad(self.__E_z_fun, 0, q_limit * 10,
-                                             args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                if inte_value_z[0] == compare_val[0]:
-                    E_z_temp.append(inte_value_z[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                    1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                    Z_temp.append(z_val)
-                elif np.abs((inte_value_z[0] - compare_val[0]) / inte_value_z[0]) < 0.05:
-                    E_z_temp.append(inte_value_z[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                    1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                    Z_temp.append(z_val)
-                else:
-                    print('Integration upper limit is too small !')
-
-        diff_E_z = np.diff(E_z_temp)
-        diff_z = np.diff(Z_temp)
-        self.__E_z_derivative_z = np.mean([i / j for i, j in zip(diff_E_z, diff_z)])
+        self.__E_z_derivative_z = self.Get_E_derivative(x, y, z, 2, 2)
 
     @property
     def E_z_derivative_z(self):
@@ -145,115 +507,21 @@ class Gaussian_Bunch:
         self.Get_E_z_derivative_z(x, y, z)
 
     def Get_E_y(self, x, y, z):
-        q_limit = self.__Get_q_limit(x, y, z)
-        while True:
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("error", integrate.IntegrationWarning)
-                    inte_value_y = integrate.quad(self.__E_y_fun, 0, q_limit,
-                                                  args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                break
-            except integrate.IntegrationWarning as e:
-                q_limit = q_limit / 5
-        while True:
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("error", integrate.IntegrationWarning)
-                    compare_val = integrate.quad(self.__E_y_fun, 0, q_limit * 10,
-                                                 args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                break
-            except integrate.IntegrationWarning as e:
-                q_limit = q_limit / 5
-        if inte_value_y[0] == compare_val[0]:
-            self.__E_y = inte_value_y[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                         1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
-        elif inte_value_y[0] == 0:
-            self.__E_y = inte_value_y[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                         1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
-            print('Please check integration limit')
-        else:
-            while np.abs((inte_value_y[0] - compare_val[0]) / inte_value_y[0]) > 0.05:
-                q_limit = q_limit * 5
-                while True:
-                    try:
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("error", integrate.IntegrationWarning)
-                            inte_value_y = integrate.quad(self.__E_y_fun, 0, q_limit,
-                                                          args=(x, y, z,
-                                                                self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                            compare_val = integrate.quad(self.__E_y_fun, 0, q_limit * 5,
-                                                         args=(x, y, z,
-                                                               self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                            break
-                    except integrate.IntegrationWarning as e:
-                        q_limit = q_limit / 2
-            self.__E_y = inte_value_y[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                         1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
+        self.__E_y, self.__E_y_error, _ = self.__Checked(self.compute_E(x, y, z, 1))
 
     @property
     def E_y(self):
         return self.__E_y
 
+    @property
+    def E_y_error(self):
+        return self.__E_y_error
+
     def set_Ey_local(self, x, y, z):
         self.Get_E_y(x, y, z)
 
     def Get_E_y_derivative_y(self, x, y, z):
-        E_y_temp = []
-        Y_temp = []
-        for y_val in np.linspace(y, y + 0.001 * self.sigma_y, 10):
-            q_limit = self.__Get_q_limit(x, y_val, z)
-            while True:
-                try:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("error", integrate.IntegrationWarning)
-                        inte_value_y = integrate.quad(self.__E_y_fun, 0, q_limit,
-                                                      args=(x, y_val, z,
-                                                            self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                    break
-                except integrate.IntegrationWarning as e:
-                    q_limit = q_limit / 5
-            while True:
-                try:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("error", integrate.IntegrationWarning)
-                        compare_val = integrate.quad(self.__E_y_fun, 0, q_limit * 10,
-                                                     args=(x, y_val, z,
-                                                           self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                    break
-                except integrate.IntegrationWarning as e:
-                    q_limit = q_limit / 5
-            if inte_value_y[0] == compare_val[0]:
-                E_y_temp.append(inte_value_y[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                Y_temp.append(y_val)
-            elif inte_value_y[0] == 0:
-                E_y_temp.append(inte_value_y[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                Y_temp.append(y_val)
-                print('Please check integration limit')
-            else:
-                while np.abs((inte_value_y[0] - compare_val[0]) / inte_value_y[0]) > 0.05:
-                    q_limit = q_limit * 5
-                    while True:
-                        try:
-                            with warnings.catch_warnings():
-                                warnings.simplefilter("error", integrate.IntegrationWarning)
-                                inte_value_y = integrate.quad(self.__E_y_fun, 0, q_limit,
-                                                              args=(x, y_val, z,
-                                                                    self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                                compare_val = integrate.quad(self.__E_y_fun, 0, q_limit * 5,
-                                                             args=(x, y_val, z,
-                                                                   self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                                break
-                        except integrate.IntegrationWarning as e:
-                            q_limit = q_limit / 2
-                E_y_temp.append(inte_value_y[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                Y_temp.append(y_val)
-
-        diff_E_y = np.diff(E_y_temp)
-        diff_y = np.diff(Y_temp)
-        self.__E_y_derivative_y = np.mean([i / j for i, j in zip(diff_E_y, diff_y)])
+        self.__E_y_derivative_y = self.Get_E_derivative(x, y, z, 1, 1)
 
     @property
     def E_y_derivative_y(self):
@@ -263,114 +531,21 @@ class Gaussian_Bunch:
         self.Get_E_y_derivative_y(x, y, z)
 
     def Get_E_x(self, x, y, z):
-        q_limit = self.__Get_q_limit(x, y, z)
-        while True:
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("error", integrate.IntegrationWarning)
-                    inte_value_x = integrate.quad(self.__E_x_fun, 0, q_limit,
-                                                  args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                break
-            except integrate.IntegrationWarning as e:
-                q_limit = q_limit / 5
-        while True:
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("error", integrate.IntegrationWarning)
-                    compare_val = integrate.quad(self.__E_x_fun, 0, q_limit * 10,
-                                                 args=(x, y, z, self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                break
-            except integrate.IntegrationWarning as e:
-                q_limit = q_limit / 5
-        if inte_value_x[0] == compare_val[0]:
-            self.__E_x = inte_value_x[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                         1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
-        elif inte_value_x[0] == 0:
-            self.__E_x = inte_value_x[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                         1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
-            print('Please check integration limit')
-        else:
-            while np.abs((inte_value_x[0] - compare_val[0]) / inte_value_x[0]) > 0.05:
-                q_limit = q_limit * 5
-                while True:
-                    try:
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("error", integrate.IntegrationWarning)
-                            inte_value_x = integrate.quad(self.__E_x_fun, 0, q_limit,
-                                                          args=(x, y, z,
-                                                                self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                            compare_val = integrate.quad(self.__E_x_fun, 0, q_limit * 5,
-                                                         args=(x, y, z,
-                                                               self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                            break
-                    except integrate.IntegrationWarning as e:
-                        q_limit = q_limit / 2
-            self.__E_x = inte_value_x[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                         1 / (4 * np.pi * Gaussian_Bunch.epsilon_0)
+        self.__E_x, self.__E_x_error, _ = self.__Checked(self.compute_E(x, y, z, 0))
 
     @property
     def E_x(self):
         return self.__E_x
 
+    @property
+    def E_x_error(self):
+        return self.__E_x_error
+
     def set_Ex_local(self, x, y, z):
         self.Get_E_x(x, y, z)
 
     def Get_E_x_derivative_x(self, x, y, z):
-        E_x_temp = []
-        X_temp = []
-        for x_val in np.linspace(x, x + 0.001 * self.sigma_x, 10):
-            q_limit = self.__Get_q_limit(x_val, y, z)
-            while True:
-                try:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("error", integrate.IntegrationWarning)
-                        inte_value_x = integrate.quad(self.__E_x_fun, 0, q_limit,
-                                                      args=(x_val, y, z,
-                                                            self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                    break
-                except integrate.IntegrationWarning as e:
-                    q_limit = q_limit / 5
-            while True:
-                try:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("error", integrate.IntegrationWarning)
-                        compare_val = integrate.quad(self.__E_x_fun, 0, q_limit * 10,
-                                                     args=(x_val, y, z,
-                                                           self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                    break
-                except integrate.IntegrationWarning as e:
-                    q_limit = q_limit / 5
-            if inte_value_x[0] == compare_val[0]:
-                E_x_temp.append(inte_value_x[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                X_temp.append(y_val)
-            elif inte_value_x[0] == 0:
-                E_x_temp.append(inte_value_x[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                X_temp.append(y_val)
-                print('Please check integration limit')
-            else:
-                while np.abs((inte_value_x[0] - compare_val[0]) / inte_value_x[0]) > 0.05:
-                    q_limit = q_limit * 5
-                    while True:
-                        try:
-                            with warnings.catch_warnings():
-                                warnings.simplefilter("error", integrate.IntegrationWarning)
-                                inte_value_x = integrate.quad(self.__E_x_fun, 0, q_limit,
-                                                              args=(x_val, y, z,
-                                                                    self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                                compare_val = integrate.quad(self.__E_x_fun, 0, q_limit * 5,
-                                                             args=(x_val, y, z,
-                                                                   self.sigma_x, self.sigma_y, self.sigma_z, self.gam))
-                                break
-                        except integrate.IntegrationWarning as e:
-                            q_limit = q_limit / 2
-                E_x_temp.append(inte_value_x[0] * constants.e * self.Number_e / (np.pi) ** 0.5 * \
-                                1 / (4 * np.pi * Gaussian_Bunch.epsilon_0))
-                X_temp.append(x_val)
-        diff_E_x = np.diff(E_x_temp)
-        diff_x = np.diff(X_temp)
-        self.__E_x_derivative_x = np.mean([i / j for i, j in zip(diff_E_x, diff_x)])
+        self.__E_x_derivative_x = self.Get_E_derivative(x, y, z, 0, 0)
 
     @property
     def E_x_derivative_x(self):
@@ -380,10 +555,7 @@ class Gaussian_Bunch:
         self.Get_E_x_derivative_x(x, y, z)
 
     def Get_B_x(self, x, y, z):
-
-        self.set_Ey_local(x, y, z)
-
-        self.__B_x = self.beta / constants.c * self.__E_y
+        self.__B_x = self.__Checked(self.compute_B(x, y, z, 0)).value
 
     @property
     def B_x(self):
@@ -393,10 +565,7 @@ class Gaussian_Bunch:
         self.Get_B_x(x, y, z)
 
     def Get_B_x_derivative_y(self, x, y, z):
-
-        self.set_Ey_derivative_y_local(x, y, z)
-
-        self.__B_x_derivative_y = self.beta / constants.c * self.__E_y_derivative_y
+        self.__B_x_derivative_y = self.beta / speed_of_light * self.Get_E_derivative(x, y, z, 1, 1)
 
     @property
     def B_x_derivative_y(self):
@@ -406,10 +575,7 @@ class Gaussian_Bunch:
         self.Get_B_x_derivative_y(x, y, z)
 
     def Get_B_y(self, x, y, z):
-
-        self.set_Ex_local(x, y, z)
-
-        self.__B_y = -self.beta / constants.c * self.__E_x
+        self.__B_y = self.__Checked(self.compute_B(x, y, z, 1)).value
 
     @property
     def B_y(self):
@@ -419,10 +585,7 @@ class Gaussian_Bunch:
         self.Get_B_y(x, y, z)
 
     def Get_B_y_derivative_x(self, x, y, z):
-
-        self.set_Ex_derivative_x_local(x, y, z)
-
-        self.__B_y_derivative_x = -self.beta / constants.c * self.__E_x_derivative_x
+        self.__B_y_derivative_x = -self.beta / speed_of_light * self.Get_E_derivative(x, y, z, 0, 0)
 
     @property
     def B_y_derivative_x(self):
@@ -0,0 +1,87 @@
+import importlib.util
+import math
+import threading
+'''
+Integrands of the q integrals of Gaussian_Bunch for scipy.integrate.quad.
+field_integrand(q, x, y, z, sigma_x, sigma_y, sigma_z, gam, component, axis) is the integrand of E_x, E_y or E_z
+(component 0, 1, 2) in the laboratory frame for axis = -1, otherwise that of dE_component/d(axis) (axis 0, 1, 2 for
+x, y, z) obtained by differentiating under the integral sign. mapped_field_integrand(s, ..., gam, q_scale, component,
+axis) integrates over s instead, q = q_scale * exp(pi/2 * sinh(s)), which maps [0, inf) onto the real line with double
+exponential decay at both ends.
+When Numba is installed they are compiled to C callbacks and handed to quad as scipy.LowLevelCallable, so QUADPACK
+runs without calling back into Python; otherwise the plain Python functions on floats are used.
+The callbacks are built on first use and cached on disk by Numba (next to this file in __pycache__), so a new process
+only pays for loading them, not for compiling.
+'''
+
+# Numba takes a noticeable time to import, it is only looked up here and imported when a callback is compiled
+numba_available = importlib.util.find_spec('numba') is not None
+
+
+def field_integrand(q, x, y, z, sigma_x, sigma_y, sigma_z, gam, component, axis):
+    # r and a in the rest frame; E_x, E_y carry a factor gam from the boost and d/dz = gam * d/dz_rest
+    r = (x, y, z * gam)
+    a = (q + 2 * sigma_x ** 2, q + 2 * sigma_y ** 2, q + 2 * (sigma_z * gam) ** 2)
+    kernel = math.exp(-r[0] ** 2 / a[0] - r[1] ** 2 / a[1] - r[2] ** 2 / a[2]) / math.sqrt(a[0] * a[1] * a[2])
+    i = int(component)
+    j = int(axis)
+    if i < 2:
+        kernel *= gam
+    if j < 0:
+        return 2 * r[i] / a[i] * kernel
+    if j == 2:
+        kernel *= gam
+    return 2 / a[i] * ((1.0 if i == j else 0.0) - 2 * r[i] * r[j] / a[j]) * kernel
+
+
+def mapped_field_integrand(s, x, y, z, sigma_x, sigma_y, sigma_z, gam, q_scale, component, axis):
+    q = q_scale * math.exp(math.pi / 2 * math.sinh(s))
+    return field_integrand(q, x, y, z, sigma_x, sigma_y, sigma_z, gam, component, axis) * \
+        q * math.pi / 2 * math.cosh(s)
+
+
+# Numba only caches functions defined at module level, so the callbacks are module functions that reach the jitted
+# integrand through this global; it is bound by _Compile before the callbacks are compiled
+_jitted_integrand = None
+
+
+def _callback(n, xx):
+    # quad passes the integration variable and the args as one array of doubles
+    return _jitted_integrand(xx[0], xx[1], xx[2], xx[3], xx[4], xx[5], xx[6], xx[7], xx[8], xx[9])
+
+
+def _mapped_callback(n, xx):
+    q = xx[8] * math.exp(math.pi / 2 * math.sinh(xx[0]))
+    return _jitted_integrand(q, xx[1], xx[2], xx[3], xx[4], xx[5], xx[6], xx[7], xx[9], xx[10]) * \
+        q * math.pi / 2 * math.cosh(xx[0])
+
+
+_compiled_integrands = {}
+_compile_lock = threading.Lock()
+
+
+def _Compile(mapped):
+    global _jitted_integrand
+    import numba
+    from scipy import LowLevelCallable
+    if _jitted_integrand is None:
+        _jitted_integrand = numba.njit(cache=True)(field_integrand)
+    signature = numba.types.float64(numba.types.intc, numba.types.CPointer(numba.types.float64))
+    callback = numba.cfunc(signature, cache=True)(_mapped_callback if mapped else _callback)
+    return LowLevelCallable(callback.ctypes)
+
+
+def get_integrand(compiled=True, mapped=False):
+    '''
+    Integrand for integrate.quad(f, a, b, args=(x, y, z, sigma_x, sigma_y, sigma_z, gam, component, axis)),
+    or with mapped=True for integrate.quad(f, s_min, s_max, args=(..., gam, q_scale, component, axis)).
+    A LowLevelCallable when compiled is True and Numba is available, the Python function otherwise.
+    '''
+    if not compiled or not numba_available:
+        return mapped_field_integrand if mapped else field_integrand
+    if mapped not in _compiled_integrands:
+        # bunches shared between threads must not compile the same callback twice
+        with _compile_lock:
+            if mapped not in _compiled_integrands:
+                _compiled_integrands[mapped] = _Compile(mapped)
+    return _compiled_integrands[mapped]
@@ -0,0 +1,60 @@
+import os
+from concurrent import futures
+import numpy as np
+'''
+Multi-core field map generation. The point set is split into chunks that are evaluated by
+Gaussian_Bunch.evaluate_fields in a pool of worker processes, every worker gets the bunch once when it starts.
+Results are written back into a preallocated array at the position of their chunk, so the output does not depend on
+the number of workers or the order in which chunks finish.
+'''
+
+_worker_bunch = None
+
+
+def _init_worker(bunch):
+    global _worker_bunch
+    _worker_bunch = bunch
+
+
+def _evaluate_chunk(start, x, y, z, options):
+    return start, np.array(_worker_bunch.evaluate_fields(x, y, z, **options))
+
+
+def parallel_evaluate_fields(bunch, x, y, z, workers=None, chunk_size=20000, out=None, **options):
+    '''
+    Parallel version of bunch.evaluate_fields(x, y, z, **options) returning an array of shape (5,) + shape with
+    E_x, E_y, E_z, B_x, B_y. workers defaults to os.cpu_count(), chunk_size is the number of points per task.
+    out can be a preallocated array (for example a np.memmap) of that shape, it is filled and returned.
+    '''
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                  np.asarray(z, dtype=float))
+    shape = x.shape
+    x, y, z = x.ravel(), y.ravel(), z.ravel()
+    if out is None:
+        out = np.empty((5,) + shape)
+    elif out.shape != (5,) + shape:
+        raise ValueError('out must have shape {}'.format((5,) + shape))
+    flat_out = out.reshape(5, -1)
+    if not np.shares_memory(flat_out, out):
+        raise ValueError('out must be contiguous')
+
+    workers = workers or os.cpu_count()
+    starts = iter(range(0, x.size, chunk_size))
+    with futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(bunch,)) as pool:
+        # at most two chunks per worker are in flight and a result is dropped as soon as it is copied into out,
+        # so the memory of the parent stays bounded by the chunk size and not by the size of the map
+        pending = set()
+        while True:
+            for start in starts:
+                pending.add(pool.submit(_evaluate_chunk, start, x[start:start + chunk_size],
+                                        y[start:start + chunk_size], z[start:start + chunk_size], options))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for task in done:
+                start, fields = task.result()
+                flat_out[:, start:start + fields.shape[1]] = fields
+            del done, task, fields
+    return out
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import numpy as np
+from GaussianBunchField import Gaussian_Bunch, speed_of_light
+'''
+Parameter scans (Energy, sigmas, Number_e) over a fixed set of points given in units of the bunch sigmas.
+In the rest frame, with lengths measured in sigma_x, the q integrals only depend on the two aspect ratios
+sigma_y/sigma_x and gam*sigma_z/sigma_x and on the normalized point (x/sigma_x, y/sigma_y, z/sigma_z):
+    E_x, E_y = gam * Number_e / sigma_x^2 * (field of the reference bunch)
+    E_z = Number_e / sigma_x^2 * (field of the reference bunch)
+where the reference bunch has sigma_x = 1, the same aspect ratios, gam = 1 and one electron. The reference fields are
+kept in an LRU cache keyed on the aspect ratios, so configurations that only differ in Number_e, in the overall size or
+in Energy at fixed gam*sigma_z are rescaled from the cache instead of being integrated again.
+'''
+
+
+class Parameter_Sweep:
+
+    def __init__(self, u, v, w, max_configurations=128, digits=12, **options):
+        '''
+        u, v, w: points in units of (sigma_x, sigma_y, sigma_z), broadcast against each other,
+        max_configurations: number of aspect ratios kept in the cache,
+        digits: significant digits of the aspect ratios in the cache key, so that ratios differing only by
+        rounding share an entry, options: passed on to Gaussian_Bunch.evaluate_fields.
+        '''
+        u, v, w = np.broadcast_arrays(np.asarray(u, dtype=float), np.asarray(v, dtype=float),
+                                      np.asarray(w, dtype=float))
+        self.__shape = u.shape
+        self.__points = (u.ravel(), v.ravel(), w.ravel())
+        self.max_configurations = max_configurations
+        self.digits = digits
+        self.options = options
+        self.__cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def invariants(self, bunch):
+        # (sigma_y/sigma_x, gam*sigma_z/sigma_x), rounded to the key precision
+        return tuple(float('{:.{}g}'.format(ratio, self.digits))
+                     for ratio in (bunch.sigma_y / bunch.sigma_x, bunch.gam * bunch.sigma_z / bunch.sigma_x))
+
+    def __Get_reference(self, key):
+        if key in self.__cache:
+            self.__cache.move_to_end(key)
+            self.hits += 1
+            return self.__cache[key]
+        self.misses += 1
+        ratio_y, ratio_z = key
+        reference = Gaussian_Bunch(Gaussian_Bunch.mass_e, 1.0, ratio_y, ratio_z, 1)
+        u, v, w = self.__points
+        E = np.array(reference.evaluate_fields(u, v * ratio_y, w * ratio_z, **self.options)[:3])
+        E.flags.writeable = False
+        self.__cache[key] = E
+        if len(self.__cache) > self.max_configurations:
+            self.__cache.popitem(last=False)
+        return E
+
+    def evaluate_fields(self, bunch):
+        '''
+        E_x, E_y, E_z, B_x, B_y of bunch at the points of the sweep (x = u*sigma_x, y = v*sigma_y, z = w*sigma_z),
+        with the shape of the broadcast u, v, w.
+        '''
+        E = self.__Get_reference(self.invariants(bunch))
+        scale = bunch.Number_e / bunch.sigma_x ** 2
+        E_x = (bunch.gam * scale * E[0]).reshape(self.__shape)
+        E_y = (bunch.gam * scale * E[1]).reshape(self.__shape)
+        E_z = (scale * E[2]).reshape(self.__shape)
+        return E_x, E_y, E_z, bunch.beta / speed_of_light * E_y, -bunch.beta / speed_of_light * E_x
+
+    def scan(self, configurations):
+        # generator over (bunch, fields) for an iterable of Gaussian_Bunch arguments (dicts or tuples)
+        for parameters in configurations:
+            if isinstance(parameters, dict):
+                bunch = Gaussian_Bunch(**parameters)
+            else:
+                bunch = Gaussian_Bunch(*parameters)
+            yield bunch, self.evaluate_fields(bunch)
+
+    def clear(self):
+        self.__cache.clear()
+        self.hits = 0
+        self.misses = 0